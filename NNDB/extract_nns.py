@@ -1,8 +1,4 @@
-from IPython import embed
-#import mega_nn
-import gc
-import numpy as np
-import pandas as pd
+from collections import OrderedDict
 from model import Network, NetworkJSON
 from peewee import Param
 import os
@@ -10,15 +6,15 @@ import sys
 networks_path = os.path.abspath(os.path.join((os.path.abspath(__file__)), '../../networks'))
 sys.path.append(networks_path)
 from run_model import QuaLiKizNDNN
+from hdf_stream import stream_store
 
-store = pd.HDFStore('./7D_nions0_flat.h5')
+store_path = './7D_nions0_flat.h5'
 features = 7
-input = store['megarun1/input']
-df = store['megarun1/flattened']
-
-#nn = mega_nn.nn
+# Rows per chunk. Memory use is a few times chunk_size * (features + 2 * targets) doubles
+chunk_size = 1000000
 
 root_name = '/megarun1/nndb_nn/'
+networks = OrderedDict()
 query = (Network.select(Network.target_names).distinct().tuples())
 for query_res in query:
     target_names, = query_res
@@ -36,36 +32,14 @@ for query_res in query:
     for subquery_res in subquery:
         id, json_dict = subquery_res
 
-
         nn = QuaLiKizNDNN(json_dict)
         network_name = parent_name + str(id)
 
-        if len(nn.feature_names) != features:
-            print('Skipping', id, ': has', len(nn.feature_names), 'features instead of', features)
+        if len(nn._feature_names) != features:
+            print('Skipping', id, ': has', len(nn._feature_names), 'features instead of', features)
             continue
+        networks[network_name] = nn
 
-        if network_name in store:
-            pass
-
-        else:
-            print('Generating ', network_name)
-            df_nn = nn.get_output(**input, clip_low=True, clip_high=True)
-            df_nn.index = input.index
-            store[network_name] = df_nn
-            del df_nn
-            gc.collect()
-
-        network_name = parent_name + str(id) + '_noclip'
-        if network_name in store:
-            pass
-        else:
-            print('Generating ', network_name)
-            df_nn = nn.get_output(**input, clip_low=False, clip_high=False)
-            df_nn.index = input.index
-            store[network_name] = df_nn
-            del df_nn
-            gc.collect()
-embed()
-#df_nn = nn.get_outputs(**input)
-#df_nn.index = input.index
-#store[] = df_nn
+# Evaluates every network once per chunk, and stores both network_name
+# and network_name + '_noclip'. Already generated rows are skipped.
+stream_store(store_path, networks, input_key='megarun1/input', chunk_size=chunk_size)
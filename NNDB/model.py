@@ -109,14 +109,16 @@ class ComboNetwork(BaseModel):
     def hidden_neurons(cls):
         raise NotImplementedError('Cannot use in SQL query')
 
-    def to_QuaLiKizComboNN(self):
-        network_ids = self.networks
-        networks = [Network.get_by_id(num).to_QuaLiKizNDNN() for num in network_ids]
-        recipe = self.recipe
-        for ii in range(len(network_ids)):
-            recipe = recipe.replace('nn' + str(ii), 'args[' + str(ii) + ']')
-        exec('def combo_func(*args): return ' + recipe, globals())
-        return QuaLiKizComboNN(self.target_names, networks, combo_func)
+    def to_QuaLiKizComboNN(self, nn_cache=None):
+        """ Create the QuaLiKizComboNN, the recipe is parsed by QuaLiKizComboNN
+
+        Networks already in nn_cache (a dict of network id -> QuaLiKizNDNN) are
+        re-used, so networks shared by several combos are only evaluated once.
+        """
+        if nn_cache is None:
+            nn_cache = {}
+        networks = [Network.get_QuaLiKizNDNN(num, nn_cache) for num in self.networks]
+        return QuaLiKizComboNN(self.target_names, networks, self.recipe)
 
     to_QuaLiKizNN = to_QuaLiKizComboNN
 
@@ -626,6 +628,13 @@ class Network(BaseModel):
         nn = QuaLiKizNDNN(json_dict)
         return nn
 
+    @classmethod
+    def get_QuaLiKizNDNN(cls, network_id, nn_cache):
+        """ QuaLiKizNDNN of network network_id, created only once per nn_cache """
+        if network_id not in nn_cache:
+            nn_cache[network_id] = cls.get_by_id(network_id).to_QuaLiKizNDNN()
+        return nn_cache[network_id]
+
     to_QuaLiKizNN = to_QuaLiKizNDNN
 
     def to_matlab(self):
@@ -659,17 +668,19 @@ class MultiNetwork(BaseModel):
 
     def to_QuaLiKizMultiNN(self):
         nns = []
+        # Networks shared by the combos are created, and evaluated, only once
+        nn_cache = {}
         if self.combo_network is not None:
-            nns.append(self.combo_network.to_QuaLiKizComboNN())
+            nns.append(self.combo_network.to_QuaLiKizComboNN(nn_cache=nn_cache))
         if self.combo_network_partners is not None:
             for nn_id in self.combo_network_partners:
-                nn = ComboNetwork.get_by_id(nn_id).to_QuaLiKizComboNN()
+                nn = ComboNetwork.get_by_id(nn_id).to_QuaLiKizComboNN(nn_cache=nn_cache)
                 nns.append(nn)
         if self.network is not None:
-            nns.append(self.network.to_QuaLiKizNDNN())
+            nns.append(Network.get_QuaLiKizNDNN(self.network.id, nn_cache))
         if self.network_partners is not None:
             for nn_id in self.network_partners:
-                nn = Network.get_by_id(nn_id).to_QuaLiKizNDNN()
+                nn = Network.get_QuaLiKizNDNN(nn_id, nn_cache)
                 nns.append(nn)
 
         return QuaLiKizMultiNN(nns)
@@ -76,7 +76,9 @@ def process_nns(nns, root_path, set, filter, leq_bound, less_bound):
     results = pd.DataFrame()
     for label, nn in nns.items():
         print('Starting on {!s}'.format(label))
-        out = nn.get_output(input, safe=False)
+        # Evaluate in tiles on all cores, instead of the full table at once
+        nn.bind_feature_order(input.columns)
+        out = pd.DataFrame(nn.predict_chunked(input.values), columns=nn._target_names)
         out.columns = pd.MultiIndex.from_product([[label], out.columns])
         print('Done! Merging')
         results = pd.concat([results, out], axis='columns')
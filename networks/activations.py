@@ -0,0 +1,47 @@
+""" Registry of the activation functions of QuaLiKizNDNN layers
+
+All backends look up activations by the name used in the network JSON
+('tanh', 'relu' or 'none'). Every activation has
+
+    apply:          allocating version, returns a new array
+    apply_inplace:  overwrites its argument, does not allocate
+    derivative:     derivative(preactivation, output) as array
+    code:           integer used by the C extension (enum act in qlknnmodule.c)
+"""
+from collections import namedtuple
+import numpy as np
+
+Activation = namedtuple('Activation', ['name', 'code', 'apply', 'apply_inplace', 'derivative'])
+
+def _tanh_inplace(x):
+    return np.tanh(x, out=x)
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+def _relu_inplace(x):
+    return np.maximum(x, 0, out=x)
+
+def _none(x):
+    return x
+
+def _tanh_derivative(preactivation, output):
+    return 1 - np.square(output)
+
+def _relu_derivative(preactivation, output):
+    return (preactivation > 0).astype(preactivation.dtype)
+
+def _none_derivative(preactivation, output):
+    return np.ones_like(preactivation)
+
+ACTIVATIONS = {
+    'tanh': Activation('tanh', 0, np.tanh, _tanh_inplace, _tanh_derivative),
+    'relu': Activation('relu', 1, _relu, _relu_inplace, _relu_derivative),
+    'none': Activation('none', 2, _none, _none, _none_derivative),
+}
+
+def get_activation(name):
+    try:
+        return ACTIVATIONS[name]
+    except KeyError:
+        raise Exception('Unknown activation {!s}, choose from {!s}'.format(name, sorted(ACTIVATIONS)))
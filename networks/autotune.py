@@ -0,0 +1,161 @@
+""" Automatic backend selection for QuaLiKizNDNN (layer_mode='auto')
+
+The available backends are timed once per host and topology on a range
+of batch sizes. The fastest backend per batch size is stored in a JSON
+file (~/.cache/qlknn/backends.json, or QLKNN_TUNING):
+
+    {hostname: {topology: {'batch_sizes': [...],
+                           'backends': [...],
+                           'timings': {backend: [seconds per call, ...]}}}}
+
+Every call is then dispatched to the backend measured fastest for the
+nearest (in log scale) tuned batch size.
+"""
+import json
+import os
+import socket
+import time
+import numpy as np
+
+TUNING_FILE = os.environ.get('QLKNN_TUNING',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'qlknn', 'backends.json'))
+BATCH_SIZES = (1, 10, 100, 1000, 10000, 100000)
+
+def available_backends():
+    """ Backends that can be used on this host
+
+    'plan' is the classic layers with a compiled InferencePlan.
+    """
+    backends = ['classic', 'plan']
+    try:
+        import qlknn
+    except ImportError:
+        pass
+    else:
+        backends.append('intel')
+    try:
+        # Loads the MKL runtime on import
+        import cython_mkl_ndnn
+    except (ImportError, OSError):
+        pass
+    else:
+        backends.append('cython')
+    try:
+        import numba_ndnn
+    except ImportError:
+        pass
+    else:
+        backends.append('numba')
+    return backends
+
+def topology_key(network):
+    """ Key of the topology of a QuaLiKizNDNN, e.g. '9-30tanh-30tanh-1none' """
+    sizes = [layer._weights.shape[1] for layer in network.layers]
+    return '-'.join(['{:d}'.format(len(network._feature_name_list))] +
+                    ['{:d}{!s}'.format(size, activation)
+                     for size, activation in zip(sizes, network._layer_activations)])
+
+def load_tuning(tuning_file=None):
+    if tuning_file is None:
+        tuning_file = TUNING_FILE
+    try:
+        with open(tuning_file) as file_:
+            return json.load(file_)
+    except (IOError, ValueError):
+        return {}
+
+def save_tuning(host, topology, tuning, tuning_file=None):
+    """ Store the tuning of one host and topology, keeping all others """
+    if tuning_file is None:
+        tuning_file = TUNING_FILE
+    tunings = load_tuning(tuning_file)
+    tunings.setdefault(host, {})[topology] = tuning
+    directory = os.path.dirname(tuning_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = '{!s}.{:d}.tmp'.format(tuning_file, os.getpid())
+    with open(tmp_path, 'w') as file_:
+        json.dump(tunings, file_, sort_keys=True, indent=4, separators=(',', ': '))
+    os.replace(tmp_path, tuning_file)
+
+def _time_per_call(func, min_time):
+    """ Best time per call of func(), calling it for at least min_time seconds """
+    best = np.inf
+    start = time.perf_counter()
+    while True:
+        call_start = time.perf_counter()
+        func()
+        now = time.perf_counter()
+        best = min(best, now - call_start)
+        if now - start > min_time:
+            return best
+
+def _tuning_input(network, n_rows):
+    """ Random input within the training domain of the network """
+    low = np.nan_to_num(network._arrays['_feature_min'])
+    high = np.nan_to_num(network._arrays['_feature_max'])
+    low, high = np.maximum(low, -1e3), np.minimum(high, 1e3)
+    rng = np.random.RandomState(0)
+    return rng.uniform(low, np.maximum(high, low), (n_rows, len(low)))
+
+def tune(predictors, network, batch_sizes=BATCH_SIZES, min_time=0.02):
+    """ Time every predictor on every batch size
+
+    predictors is a dict of backend -> function(input, out). Returns a dict
+    with the fastest backend per batch size and all timings.
+    """
+    batch_sizes = sorted(batch_sizes)
+    input = _tuning_input(network, batch_sizes[-1])
+    out = np.empty((batch_sizes[-1], len(network._target_name_list)))
+    timings = {}
+    for backend, predict in predictors.items():
+        timings[backend] = []
+        for n_rows in batch_sizes:
+            func = lambda: predict(input[:n_rows], out[:n_rows])
+            timings[backend].append(_time_per_call(func, min_time))
+    backends = [min(timings, key=lambda backend: timings[backend][ii])
+                for ii in range(len(batch_sizes))]
+    return {'batch_sizes': batch_sizes, 'backends': backends, 'timings': timings}
+
+class BackendDispatcher():
+    """ Dispatches evaluations of a network to the fastest backend
+
+    The tuning is loaded from tuning_file if it is there for this host and
+    topology and all its backends are available, and measured otherwise.
+    """
+    def __init__(self, network, nn_dict, tuning_file=None, batch_sizes=BATCH_SIZES, retune=False):
+        host = socket.gethostname()
+        topology = topology_key(network)
+        available = available_backends()
+        tuning = None
+        if not retune:
+            tuning = load_tuning(tuning_file).get(host, {}).get(topology)
+        if tuning is None or not set(tuning['backends']) <= set(available):
+            predictors = {backend: self._create_predictor(network, nn_dict, backend)
+                          for backend in available}
+            tuning = tune(predictors, network, batch_sizes=batch_sizes)
+            save_tuning(host, topology, tuning, tuning_file=tuning_file)
+        else:
+            predictors = {backend: self._create_predictor(network, nn_dict, backend)
+                          for backend in set(tuning['backends'])}
+        self.tuning = tuning
+        self._predictors = [predictors[backend] for backend in tuning['backends']]
+        # Switch between two tuned batch sizes halfway in log scale
+        sizes = np.array(tuning['batch_sizes'], dtype='float64')
+        self._boundaries = np.sqrt(sizes[1:] * sizes[:-1])
+
+    @staticmethod
+    def _create_predictor(network, nn_dict, backend):
+        from run_model import QuaLiKizNDNN, InferencePlan
+        if backend == 'classic':
+            return network._predict_layers
+        if backend == 'plan':
+            return InferencePlan(network).apply
+        return QuaLiKizNDNN(nn_dict, layer_mode=backend)._predict
+
+    def backend(self, n_rows):
+        """ Name of the backend used for n_rows rows """
+        return self.tuning['backends'][np.searchsorted(self._boundaries, n_rows)]
+
+    def predict(self, input, out=None):
+        return self._predictors[np.searchsorted(self._boundaries, input.shape[0])](input, out)
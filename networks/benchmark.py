@@ -0,0 +1,581 @@
+""" Benchmarks for the QuaLiKizNDNN inference paths
+
+The networks used here are synthetic: random weights with the topology of
+the networks we ship, so the benchmarks can run without any trained JSON
+file around.
+
+Run as a script to time every stage and every available backend of the
+shipped topologies, check that the backends agree, and write the results
+as JSON. Compare with earlier result files to find regressions:
+
+    python benchmark.py --output new.json --compare old.json
+
+The speed of a shared host can drift by tens of percent between runs.
+Keep several results of the reference code and compare with all of them,
+which uses their median per record:
+
+    python benchmark.py --output new.json --compare old1.json old2.json old3.json
+"""
+import argparse
+from collections import OrderedDict
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from run_model import (QuaLiKizNDNN, QuaLiKizMultiNN, QuaLiKizComboNN, compare_precision,
+                       determine_settings, clip_to_bounds, _prescale)
+from activations import ACTIVATIONS
+from autotune import available_backends
+from nn_memo import MemoizedNN
+
+# Hidden layers of the networks we ship
+TOPOLOGIES = {
+    '3x30': (30, 30, 30),
+    '3x64': (64, 64, 64),
+    '2x60': (60, 60),
+    '3x96': (96, 96, 96),
+}
+BATCH_SIZES = (1, 10, 100, 1000, 10000, 100000, 1000000)
+# Backends should agree to this relative tolerance, relative to the
+# largest output
+AGREEMENT_RTOL = 1e-9
+# Modules of the inference core, and what they should not import
+LEAN_MODULES = ('run_model', 'nn_io', 'activations')
+HEAVY_MODULES = ('pandas', 'IPython', 'matplotlib', 'scipy', 'peewee', 'numba')
+
+feature_names_9D = ['Zeffx', 'Ati', 'Ate', 'An', 'qx', 'smag', 'x', 'Ti_Te', 'logNustar']
+
+def synthetic_nn_dict(hidden_neurons=(30, 30, 30), hidden_activation='tanh',
+                      output_activation='none', feature_names=None,
+                      target_names=('efe_GB', ), seed=0):
+    """ Build a nn_dict as read from a QuaLiKiz-Tensorflow JSON file """
+    if feature_names is None:
+        feature_names = feature_names_9D
+    feature_names = list(feature_names)
+    target_names = list(target_names)
+    if isinstance(hidden_activation, str):
+        hidden_activation = [hidden_activation] * len(hidden_neurons)
+    rng = np.random.RandomState(seed)
+    nn_dict = {}
+    sizes = [len(feature_names)] + list(hidden_neurons) + [len(target_names)]
+    for ii in range(1, len(sizes)):
+        nn_dict['layer' + str(ii) + '/weights/Variable:0'] = rng.normal(size=(sizes[ii - 1], sizes[ii])).tolist()
+        nn_dict['layer' + str(ii) + '/biases/Variable:0'] = rng.normal(size=sizes[ii]).tolist()
+    names = feature_names + target_names
+    nn_dict['prescale_factor'] = dict(zip(names, rng.uniform(0.1, 1, len(names))))
+    nn_dict['prescale_bias'] = dict(zip(names, rng.uniform(-1, 1, len(names))))
+    nn_dict['feature_min'] = dict(zip(feature_names, np.full(len(feature_names), -1.)))
+    nn_dict['feature_max'] = dict(zip(feature_names, np.full(len(feature_names), 10.)))
+    nn_dict['target_min'] = dict(zip(target_names, np.full(len(target_names), -5.)))
+    nn_dict['target_max'] = dict(zip(target_names, np.full(len(target_names), 5.)))
+    nn_dict['feature_names'] = feature_names
+    nn_dict['target_names'] = target_names
+    nn_dict['hidden_activation'] = list(hidden_activation)
+    nn_dict['output_activation'] = output_activation
+    return nn_dict
+
+def synthetic_input(nn, n_rows, seed=1):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 10, (n_rows, len(nn._feature_names)))
+
+def time_per_call(func, min_time=0.2, repeat=5):
+    """ Best time per call of func() over repeat rounds of at least min_time seconds """
+    return min(round_times(func, min_time, repeat))
+
+def round_times(func, min_time=0.2, repeat=5):
+    """ Time per call of func() in each of repeat rounds of at least min_time / repeat seconds """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time / repeat:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+def transient_bytes_per_call(func):
+    """ Peak memory allocated (and freed again) during a single call of func() """
+    func()
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - start
+
+def check_unknown_bounds(n_rows=100):
+    """ Names of the methods that clip to an unknown (NaN) combo bound
+
+    A target_min of 0 for nn0 and of -1 for nn1 makes the target_min of
+    nn0 / (nn1 + 1) NaN, which should not clip the output, as it did not
+    when clip_to_bounds compared column by column.
+    """
+    nn0_dict = synthetic_nn_dict((30, 30), seed=0)
+    nn0_dict['target_min'] = {'efe_GB': 0.}
+    nn1_dict = synthetic_nn_dict((30, 30), target_names=('efi_GB', ), seed=1)
+    nn1_dict['target_min'] = {'efi_GB': -1.}
+    nn0 = QuaLiKizNDNN(nn0_dict, layer_mode='classic')
+    nn1 = QuaLiKizNDNN(nn1_dict, layer_mode='classic')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        combo = QuaLiKizComboNN(['efe_efi'], [nn0, nn1], 'nn0 / (nn1 + 1)')
+        input = synthetic_input(combo, n_rows)
+        expected = combo._predict(input)
+        high_bound = combo._target_max.values
+        expected[expected > high_bound] = high_bound
+        frame = pd.DataFrame(input, columns=combo._feature_names)
+        outputs = {
+            'predict_array': combo.predict_array(input),
+            'get_output': combo.get_output(frame, output_pandas=False, safe=True),
+            'get_output(low_bound)': combo.get_output(frame, output_pandas=False, safe=True,
+                                                      low_bound=combo._target_min,
+                                                      high_bound=combo._target_max),
+            'sweep': combo.sweep(input[0], 'Ati', input[:, 1])
+        }
+        expected_sweep = input[np.zeros(n_rows, dtype=int)]
+        expected_sweep[:, 1] = input[:, 1]
+        expected_sweep = np.minimum(combo._predict(expected_sweep), high_bound)
+    failures = []
+    for name, output in outputs.items():
+        reference = expected_sweep if name == 'sweep' else expected
+        if not np.array_equal(np.isnan(output), np.isnan(reference)) or \
+                not np.allclose(output, reference, equal_nan=True):
+            failures.append(name)
+    return failures
+
+def bench_plan(hidden_neurons=(30, 30, 30), batch_sizes=(1, 10, 100, 1000, 10000)):
+    """ Compare the classic layer-by-layer path with the InferencePlan """
+    nn = QuaLiKizNDNN(synthetic_nn_dict(hidden_neurons), layer_mode='classic')
+    results = []
+    for n_rows in batch_sizes:
+        input = synthetic_input(nn, n_rows)
+        out = np.empty((n_rows, len(nn._target_names)))
+        nn.clear_plan()
+        reference = nn.get_output(input, safe=False, output_pandas=False,
+                                  clip_low=False, clip_high=False)
+        classic = lambda: nn.get_output(input, safe=False, output_pandas=False)
+        row = {'batch_size': n_rows,
+               'classic_time': time_per_call(classic),
+               'classic_bytes': transient_bytes_per_call(classic)}
+        for fold in [False, True]:
+            name = 'plan_fold' if fold else 'plan'
+            plan = nn.compile_plan(fold=fold)
+            plan_out = plan.apply(input, out=out)
+            row[name + '_maxdiff'] = np.max(np.abs(plan_out - reference))
+            row[name + '_time'] = time_per_call(lambda: plan.apply(input, out=out))
+            row[name + '_bytes'] = transient_bytes_per_call(lambda: plan.apply(input, out=out))
+        nn.clear_plan()
+        results.append(row)
+    return pd.DataFrame(results).set_index('batch_size')
+
+def bench_stacked(n_networks=11, hidden_neurons=(30, 30, 30), batch_sizes=(1, 10, 100, 1000, 10000)):
+    """ Compare looping over the networks of a QuaLiKizMultiNN with a StackedPlan """
+    nns = [QuaLiKizNDNN(synthetic_nn_dict(hidden_neurons, target_names=['target' + str(ii)], seed=ii),
+                        layer_mode='classic')
+           for ii in range(n_networks)]
+    multi = QuaLiKizMultiNN(nns)
+    results = []
+    for n_rows in batch_sizes:
+        input = synthetic_input(multi, n_rows)
+        call = lambda: multi.get_output(input, safe=False, output_pandas=False)
+        multi.clear_plan()
+        reference = call()
+        row = {'batch_size': n_rows,
+               'loop_time': time_per_call(call)}
+        multi.compile_plan()
+        row['stacked_maxdiff'] = np.max(np.abs(call() - reference))
+        row['stacked_time'] = time_per_call(call)
+        multi.clear_plan()
+        results.append(row)
+    return pd.DataFrame(results).set_index('batch_size')
+
+def bench_predict_array(hidden_neurons=(30, 30, 30), batch_sizes=(1, 10, 100, 1000)):
+    """ Compare the pandas get_output path with predict_array """
+    nn = QuaLiKizNDNN(synthetic_nn_dict(hidden_neurons), layer_mode='classic')
+    results = []
+    for n_rows in batch_sizes:
+        input = synthetic_input(nn, n_rows)
+        frame = pd.DataFrame(input, columns=nn._feature_names)
+        out = np.empty((n_rows, len(nn._target_names)))
+        row = {'batch_size': n_rows,
+               'get_output_pandas_time': time_per_call(lambda: nn.get_output(frame)),
+               'get_output_array_time': time_per_call(
+                   lambda: nn.get_output(input, safe=False, output_pandas=False)),
+               'predict_array_time': time_per_call(lambda: nn.predict_array(input, out=out))}
+        results.append(row)
+    return pd.DataFrame(results).set_index('batch_size')
+
+def bench_precision(hidden_neurons=(30, 30, 30), batch_sizes=(100, 10000, 100000)):
+    """ Compare float64 inference with float32 and mixed precision """
+    nn_dict = synthetic_nn_dict(hidden_neurons)
+    nns = {precision: QuaLiKizNDNN(nn_dict, layer_mode='classic', precision=precision)
+           for precision in ['float64', 'float32', 'mixed']}
+    results = []
+    for n_rows in batch_sizes:
+        input = synthetic_input(nns['float64'], n_rows)
+        out = np.empty((n_rows, len(nns['float64']._target_names)))
+        row = {'batch_size': n_rows}
+        for precision, nn in nns.items():
+            row[precision + '_time'] = time_per_call(lambda: nn.predict_array(input, out=out))
+            if precision != 'float64':
+                deviation = compare_precision(nns['float64'], nn, input)
+                row[precision + '_max_deviation'] = deviation['max_deviation'].max()
+                row[precision + '_rms_deviation'] = deviation['rms_deviation'].max()
+        results.append(row)
+    return pd.DataFrame(results).set_index('batch_size')
+
+def bench_activations(widths=(30, 64, 96), batch_sizes=(1, 100, 10000)):
+    """ Compare the old allocating activations with the in-place kernels """
+    old = {'tanh': np.tanh,
+           'relu': lambda x: x * (x > 0)}
+    rng = np.random.RandomState(0)
+    results = []
+    for width in widths:
+        for n_rows in batch_sizes:
+            x = rng.normal(size=(n_rows, width))
+            for name, old_func in old.items():
+                kernel = ACTIVATIONS[name].apply_inplace
+                work = x.copy()
+                row = {'width': width, 'batch_size': n_rows, 'activation': name,
+                       'maxdiff': np.max(np.abs(kernel(x.copy()) - old_func(x))),
+                       'old_time': time_per_call(lambda: old_func(x)),
+                       'old_bytes': transient_bytes_per_call(lambda: old_func(x)),
+                       'inplace_time': time_per_call(lambda: kernel(work)),
+                       'inplace_bytes': transient_bytes_per_call(lambda: kernel(work))}
+                results.append(row)
+    return pd.DataFrame(results).set_index(['activation', 'width', 'batch_size'])
+
+def bench_chunked(hidden_neurons=(96, 96, 96), n_rows=1000000, chunk_sizes=(1024, 4096, 16384), workers=(1, 2, 4)):
+    """ Compare one-shot predict_array with tiled, threaded predict_chunked """
+    nn = QuaLiKizNDNN(synthetic_nn_dict(hidden_neurons), layer_mode='classic')
+    nn.compile_plan()
+    input = synthetic_input(nn, n_rows)
+    results = [{'chunk_size': n_rows, 'workers': 1,
+                'time': time_per_call(lambda: nn.predict_array(input), repeat=1),
+                'bytes': transient_bytes_per_call(lambda: nn.predict_array(input))}]
+    for chunk_size in chunk_sizes:
+        for n_workers in workers:
+            call = lambda: nn.predict_chunked(input, chunk_size=chunk_size, workers=n_workers)
+            results.append({'chunk_size': chunk_size, 'workers': n_workers,
+                            'time': time_per_call(call, repeat=1),
+                            'bytes': transient_bytes_per_call(call)})
+    return pd.DataFrame(results).set_index(['chunk_size', 'workers'])
+
+def bench_memo(hidden_neurons=(30, 30, 30), batch_sizes=(1, 24, 1000), repeated=(0., 0.9, 1.)):
+    """ predict_array with and without MemoizedNN
+
+    Every call a fraction `repeated` of the rows is the same as in the
+    previous call, as for a steady-state phase of a simulation.
+    """
+    nn = QuaLiKizNDNN(synthetic_nn_dict(hidden_neurons), layer_mode='classic')
+    results = []
+    for n_rows in batch_sizes:
+        for fraction in repeated:
+            memo = MemoizedNN(nn)
+            input = synthetic_input(nn, n_rows)
+            n_new = n_rows - int(round(fraction * n_rows))
+            rng = np.random.RandomState(2)
+            def call():
+                input[:n_new] = rng.uniform(0, 10, (n_new, input.shape[1]))
+                return memo.predict_array(input)
+            results.append({'batch_size': n_rows, 'repeated': fraction,
+                            'time': time_per_call(lambda: nn.predict_array(input)),
+                            'memo_time': time_per_call(call),
+                            'hit_rate': memo.stats()['hit_rate']})
+    return pd.DataFrame(results).set_index(['batch_size', 'repeated'])
+
+def _suite_times(func, n_rows):
+    """ Best and median time per call of one pass of run_suite
+
+    With fewer rounds for the slow, large batches, the passes give them as
+    many rounds as before.
+    """
+    if n_rows >= 100000:
+        times = round_times(func, min_time=0, repeat=1)
+    elif n_rows >= 10000:
+        times = round_times(func, min_time=0.1, repeat=2)
+    else:
+        times = round_times(func, min_time=0.1, repeat=5)
+    return {'time': min(times), 'time_median': float(np.median(times))}
+
+def bench_stages(hidden_neurons=(30, 30, 30), batch_sizes=BATCH_SIZES):
+    """ Time the stages of the classic get_output path separately
+
+    Returns a list of records with the stage, batch_size and time per call.
+    """
+    nn = QuaLiKizNDNN(synthetic_nn_dict(hidden_neurons), layer_mode='classic')
+    feature_factor, feature_bias, target_factor, target_bias = nn._prescale_arrays
+    low_bound, high_bound = nn._target_bounds
+    records = []
+    for n_rows in batch_sizes:
+        input = synthetic_input(nn, n_rows)
+        frame = pd.DataFrame(input, columns=nn._feature_names)
+        prescaled = _prescale(input, feature_factor, feature_bias)
+        layers_out = nn.apply_layers(prescaled)
+        output = (layers_out - target_bias) / target_factor
+        out = np.empty_like(output)
+        stages = [
+            ('determine_settings', lambda: determine_settings(nn, frame, True, True, True, None, None)),
+            ('prescale', lambda: _prescale(input, feature_factor, feature_bias)),
+            ('apply_layers', lambda: nn.apply_layers(prescaled)),
+            ('descale', lambda: (layers_out - target_bias) / target_factor),
+            ('clip', lambda: clip_to_bounds(output, True, True, low_bound, high_bound)),
+            ('to_pandas', lambda: pd.DataFrame(output, columns=nn._target_names)),
+            ('get_output', lambda: nn.get_output(frame)),
+            ('predict_array', lambda: nn.predict_array(input, out=out)),
+        ]
+        for stage, func in stages:
+            record = {'stage': stage, 'batch_size': n_rows}
+            record.update(_suite_times(func, n_rows))
+            records.append(record)
+    return records
+
+def _backend_predictors(nn_dict, backends):
+    """ predict_array of a network per backend, as in autotune """
+    predictors = {}
+    for backend in backends:
+        if backend == 'plan':
+            nn = QuaLiKizNDNN(nn_dict, layer_mode='classic')
+            nn.compile_plan()
+        else:
+            nn = QuaLiKizNDNN(nn_dict, layer_mode=backend)
+        predictors[backend] = nn.predict_array
+    return predictors
+
+def bench_backends(hidden_neurons=(30, 30, 30), batch_sizes=BATCH_SIZES, backends=None):
+    """ Time predict_array of every backend and check them against classic
+
+    Returns a list of records with the backend, batch_size, time per call,
+    maximum deviation from the classic backend and whether that deviation
+    is within AGREEMENT_RTOL.
+    """
+    if backends is None:
+        backends = available_backends()
+    nn_dict = synthetic_nn_dict(hidden_neurons)
+    predictors = _backend_predictors(nn_dict, backends)
+    reference = QuaLiKizNDNN(nn_dict, layer_mode='classic')
+    records = []
+    for n_rows in batch_sizes:
+        input = synthetic_input(reference, n_rows)
+        expected = reference.predict_array(input)
+        tolerance = AGREEMENT_RTOL * max(np.max(np.abs(expected)), 1)
+        out = np.empty_like(expected)
+        for backend, predict in predictors.items():
+            deviation = float(np.max(np.abs(predict(input, out=out) - expected)))
+            record = {'backend': backend, 'batch_size': n_rows,
+                      'max_deviation': deviation,
+                      'agrees': bool(deviation <= tolerance)}
+            record.update(_suite_times(lambda: predict(input, out=out), n_rows))
+            records.append(record)
+    return records
+
+def run_suite(topologies=None, batch_sizes=BATCH_SIZES, backends=None, verbose=True, passes=3):
+    """ Run bench_stages and bench_backends for all topologies
+
+    Returns a JSON-serializable dict with the environment and all records.
+    Every record has a topology, a 'kind' (stage, backend or import) and a
+    name. The import time of the inference core is measured once.
+
+    The benchmarks are run in passes over the whole suite, so that the
+    rounds of every record are spread over the run and a period in which
+    the host is slow does not affect a few records only. The time of a
+    record is the best of all passes, time_median the median of the
+    medians of the passes.
+    """
+    if topologies is None:
+        topologies = sorted(TOPOLOGIES)
+    if backends is None:
+        backends = available_backends()
+    passes_records = OrderedDict()
+    for ii in range(passes):
+        for topology in topologies:
+            hidden_neurons = TOPOLOGIES[topology]
+            if verbose:
+                print('Benchmarking', topology, 'pass', ii + 1, 'of', passes, file=sys.stderr)
+            pass_records = []
+            for record in bench_stages(hidden_neurons, batch_sizes):
+                record.update({'topology': topology, 'kind': 'stage', 'name': record.pop('stage')})
+                pass_records.append(record)
+            for record in bench_backends(hidden_neurons, batch_sizes, backends):
+                record.update({'topology': topology, 'kind': 'backend', 'name': record.pop('backend')})
+                pass_records.append(record)
+            for record in pass_records:
+                key = (record['topology'], record['kind'], record['name'], record['batch_size'])
+                passes_records.setdefault(key, []).append(record)
+    records = []
+    for key, pass_records in passes_records.items():
+        record = dict(pass_records[-1])
+        record['time'] = min(pass_record['time'] for pass_record in pass_records)
+        record['time_median'] = float(np.median([pass_record['time_median'] for pass_record in pass_records]))
+        if 'agrees' in record:
+            record['agrees'] = all(pass_record['agrees'] for pass_record in pass_records)
+            record['max_deviation'] = max(pass_record['max_deviation'] for pass_record in pass_records)
+        records.append(record)
+    for record in bench_import():
+        # Imports do not depend on the topology and batch size
+        record.update({'topology': '-', 'kind': 'import', 'name': record.pop('module'), 'batch_size': 0})
+        records.append(record)
+    return {
+        'environment': {
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'backends': list(backends),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'records': records,
+    }
+
+_import_script = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'modules': sorted(sys.modules)}}))
+"""
+
+def bench_import(modules=LEAN_MODULES, repeat=5):
+    """ Import time of the inference core in a fresh interpreter
+
+    numpy is imported before the clock starts, so the time is that of the
+    module itself. Returns a list of records with the module, the best and
+    median import time and the heavy modules it pulled in (should be none).
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    records = []
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            script = 'import numpy\n' + _import_script.format(module=module)
+            result = json.loads(subprocess.check_output([sys.executable, '-c', script], cwd=directory))
+            times.append(result['time'])
+        heavy = [name for name in HEAVY_MODULES if name in result['modules']]
+        records.append({'module': module, 'time': min(times), 'time_median': float(np.median(times)),
+                        'heavy_modules': heavy})
+    return records
+
+def save_results(results, path):
+    with open(path, 'w') as file_:
+        json.dump(results, file_, sort_keys=True, indent=4, separators=(',', ': '))
+
+def load_results(path):
+    with open(path) as file_:
+        return json.load(file_)
+
+def results_frame(results):
+    """ The records of run_suite as DataFrame indexed by (topology, kind, name, batch_size) """
+    return (pd.DataFrame(results['records'])
+            .set_index(['topology', 'kind', 'name', 'batch_size'])
+            .sort_index())
+
+def compare_results(old, new, threshold=1.2, min_difference=5e-6):
+    """ Compare the times of run_suite results
+
+    old is a result or a list of results of earlier runs, of which the
+    median per record is taken. Returns a DataFrame with the old and new
+    (best) time and their ratio for all records in both.
+
+    To not flag the noise of a busy host, a record is a regression only if
+    its new best time is more than threshold times the old median time, and
+    more than min_difference seconds slower than the old best time.
+    """
+    if isinstance(old, dict):
+        old = [old]
+    old_frames = []
+    for results in old:
+        frame = results_frame(results)
+        if 'time_median' not in frame:
+            # Results from before the median was recorded
+            frame['time_median'] = frame['time']
+        old_frames.append(frame[['time', 'time_median']])
+    old_frame = pd.concat(old_frames).groupby(level=[0, 1, 2, 3]).median()
+    new_frame = results_frame(new)
+    comparison = pd.DataFrame({'old_time': old_frame['time'], 'old_median': old_frame['time_median'],
+                               'new_time': new_frame['time']}).dropna()
+    comparison['ratio'] = comparison['new_time'] / comparison['old_time']
+    comparison['regression'] = ((comparison['new_time'] > threshold * comparison['old_median']) &
+                                (comparison['new_time'] - comparison['old_time'] > min_difference))
+    return comparison
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the QuaLiKizNDNN inference paths')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', nargs='+',
+                        help='compare with the results in these JSON files (the median of them)')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio that counts as a regression (default 1.2)')
+    parser.add_argument('--min-difference', type=float, default=5e-6,
+                        help='smallest slowdown in seconds that counts as a regression (default 5e-6)')
+    parser.add_argument('--topologies', nargs='+', choices=sorted(TOPOLOGIES),
+                        help='topologies to benchmark (default all)')
+    parser.add_argument('--max-batch-size', type=float, default=max(BATCH_SIZES),
+                        help='largest batch size (default 1e6)')
+    parser.add_argument('--backends', nargs='+', help='backends to benchmark (default all available)')
+    parser.add_argument('--passes', type=int, default=3,
+                        help='passes over the suite, more give more stable times (default 3)')
+    parser.add_argument('--detailed', action='store_true',
+                        help='also print the plan, stacked, precision and chunked benchmarks')
+    args = parser.parse_args(argv)
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_rows', 500)
+    batch_sizes = [n_rows for n_rows in BATCH_SIZES if n_rows <= args.max_batch_size]
+    results = run_suite(args.topologies, batch_sizes, args.backends, passes=args.passes)
+    frame = results_frame(results)
+    print(frame)
+    if args.output:
+        save_results(results, args.output)
+    disagree = frame[frame['agrees'] == False]
+    if len(disagree) > 0:
+        print('Backends that do not agree with classic:')
+        print(disagree)
+    imports = frame.xs('import', level='kind')['heavy_modules']
+    heavy_imports = imports[imports.apply(len) > 0]
+    if len(heavy_imports) > 0:
+        print('Inference core imports heavy modules:')
+        print(heavy_imports)
+    bound_failures = check_unknown_bounds()
+    if len(bound_failures) > 0:
+        print('Clipped to unknown bounds:', bound_failures)
+    regressions = 0
+    if args.compare:
+        comparison = compare_results([load_results(path) for path in args.compare], results,
+                                     args.threshold, args.min_difference)
+        print(comparison)
+        regressions = comparison['regression'].sum()
+        print('{:d} regressions'.format(regressions))
+
+    if args.detailed:
+        print(bench_activations())
+        for hidden_neurons in [TOPOLOGIES[topology] for topology in args.topologies or sorted(TOPOLOGIES)]:
+            print('Topology', 'x'.join(str(neurons) for neurons in hidden_neurons))
+            print(bench_plan(hidden_neurons))
+            print(bench_stacked(hidden_neurons=hidden_neurons))
+            print(bench_predict_array(hidden_neurons))
+            print(bench_precision(hidden_neurons))
+            print(bench_memo(hidden_neurons))
+        print(bench_chunked())
+    return int(len(disagree) > 0 or len(heavy_imports) > 0 or len(bound_failures) > 0 or regressions > 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+""" Combo recipes: arithmetic on the outputs of the networks of a combo
+
+A recipe is an expression in the outputs nn0, nn1, ... of the networks of
+a QuaLiKizComboNN, as stored in the NNDB, e.g.
+
+    '(nn0 * nn1) / (1 + nn0 + nn2)'
+
+It is parsed (not exec'd) into a DAG in which every distinct subexpression
+is a single node, so nn0 + 1 in '(nn0 * nn1) / (nn0 + 1) + nn1 / (nn0 + 1)'
+is calculated once. Constant subexpressions are folded while parsing.
+Supported are numbers, +, -, *, /, ** and abs().
+
+A Recipe can be used as combo_func. Called with any operands that support
+the arithmetic (arrays, DataFrames, the dual numbers of predict_jacobian)
+it evaluates node by node. evaluate() is the fast path for arrays: it runs
+a precompiled list of ufunc calls, each writing into a reused buffer.
+"""
+import ast
+import numpy as np
+
+_binary_ops = {
+    ast.Add: 'add',
+    ast.Sub: 'sub',
+    ast.Mult: 'mul',
+    ast.Div: 'div',
+    ast.Pow: 'pow',
+}
+_unary_ops = {
+    ast.USub: 'neg',
+    ast.UAdd: None,
+}
+_commutative = ('add', 'mul')
+
+_python_ops = {
+    'add': lambda a, b: a + b,
+    'sub': lambda a, b: a - b,
+    'mul': lambda a, b: a * b,
+    'div': lambda a, b: a / b,
+    'pow': lambda a, b: a ** b,
+    'neg': lambda a: -a,
+    'abs': abs,
+}
+_ufuncs = {
+    'add': np.add,
+    'sub': np.subtract,
+    'mul': np.multiply,
+    'div': np.true_divide,
+    'pow': np.power,
+    'neg': np.negative,
+    'abs': np.absolute,
+}
+
+class Recipe():
+    """ A parsed combo recipe, callable as combo_func(nn0, nn1, ...) """
+    def __init__(self, recipe):
+        self.recipe = recipe
+        # Every node is (op, operands); operands are node indices, except
+        # for 'input' (the network index) and 'const' (the value)
+        self._nodes = []
+        self._node_index = {}
+        try:
+            tree = ast.parse(recipe.strip(), mode='eval')
+        except SyntaxError:
+            raise Exception('Could not parse recipe {!r}'.format(recipe))
+        self._output = self._add_expression(tree.body)
+        inputs = [operands[0] for op, operands in self._nodes if op == 'input']
+        self.n_inputs = max(inputs) + 1 if len(inputs) > 0 else 0
+        self._compile()
+
+    def __repr__(self):
+        return 'Recipe({!r})'.format(self.recipe)
+
+    def _add_node(self, op, operands):
+        if op in _commutative:
+            operands = tuple(sorted(operands))
+        if op in _python_ops and all(self._nodes[ii][0] == 'const' for ii in operands):
+            # Fold constant subexpressions
+            value = _python_ops[op](*[self._nodes[ii][1][0] for ii in operands])
+            op, operands = 'const', (float(value), )
+        key = (op, operands)
+        if key not in self._node_index:
+            self._node_index[key] = len(self._nodes)
+            self._nodes.append(key)
+        return self._node_index[key]
+
+    def _add_expression(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in _binary_ops:
+            return self._add_node(_binary_ops[type(node.op)],
+                                  (self._add_expression(node.left), self._add_expression(node.right)))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_ops:
+            operand = self._add_expression(node.operand)
+            if _unary_ops[type(node.op)] is None:
+                return operand
+            return self._add_node(_unary_ops[type(node.op)], (operand, ))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'abs'
+                and len(node.args) == 1 and len(node.keywords) == 0):
+            return self._add_node('abs', (self._add_expression(node.args[0]), ))
+        if (isinstance(node, ast.Constant) and isinstance(node.value, (int, float))
+                and not isinstance(node.value, bool)):
+            return self._add_node('const', (float(node.value), ))
+        if isinstance(node, ast.Name) and node.id.startswith('nn') and node.id[2:].isdigit():
+            return self._add_node('input', (int(node.id[2:]), ))
+        raise Exception('Unsupported expression {!r} in recipe {!r}'.format(
+            ast.dump(node), self.recipe))
+
+    def _compile(self):
+        """ Schedule the nodes as ufunc calls on a minimal set of buffers """
+        last_use = {}
+        for ii, (op, operands) in enumerate(self._nodes):
+            if op in _ufuncs:
+                for operand in operands:
+                    last_use[operand] = ii
+        slots = {}
+        free = []
+        self._n_slots = 0
+        self._steps = []
+        for ii, (op, operands) in enumerate(self._nodes):
+            if op not in _ufuncs:
+                continue
+            # Operands used for the last time free their buffer, which can
+            # be written in-place by this (elementwise) step
+            for operand in set(operands):
+                if operand in slots and last_use[operand] == ii:
+                    free.append(slots[operand])
+            if ii == self._output:
+                slot = None
+            elif len(free) > 0:
+                slot = free.pop()
+            else:
+                slot = self._n_slots
+                self._n_slots += 1
+            slots[ii] = slot
+            refs = []
+            for operand in operands:
+                operand_op, value = self._nodes[operand]
+                if operand_op == 'input':
+                    refs.append(('input', value[0]))
+                elif operand_op == 'const':
+                    refs.append(('const', value[0]))
+                else:
+                    refs.append(('slot', slots[operand]))
+            self._steps.append((_ufuncs[op], refs, slot))
+
+    def __call__(self, *args):
+        """ Evaluate with Python arithmetic, for any type of operands """
+        if len(args) < self.n_inputs:
+            raise Exception('Recipe {!r} needs {:d} inputs, got {:d}'.format(
+                self.recipe, self.n_inputs, len(args)))
+        values = []
+        for op, operands in self._nodes:
+            if op == 'input':
+                values.append(args[operands[0]])
+            elif op == 'const':
+                values.append(operands[0])
+            else:
+                values.append(_python_ops[op](*[values[ii] for ii in operands]))
+        return values[self._output]
+
+    def evaluate(self, args, out=None):
+        """ Evaluate on arrays with in-place ufuncs
+
+        The arguments are broadcast against each other. The result is
+        written into out if it is given. The arguments are never modified.
+        """
+        if len(args) < self.n_inputs:
+            raise Exception('Recipe {!r} needs {:d} inputs, got {:d}'.format(
+                self.recipe, self.n_inputs, len(args)))
+        args = [np.asarray(arg) for arg in args]
+        shape = np.broadcast_shapes(*[arg.shape for arg in args])
+        if out is None:
+            out = np.empty(shape)
+        op, operands = self._nodes[self._output]
+        if op == 'input':
+            out[...] = args[operands[0]]
+            return out
+        if op == 'const':
+            out[...] = operands[0]
+            return out
+        buffers = [np.empty(shape) for _ in range(self._n_slots)]
+        for ufunc, refs, slot in self._steps:
+            operands = []
+            for kind, value in refs:
+                if kind == 'input':
+                    operands.append(args[value])
+                elif kind == 'const':
+                    operands.append(value)
+                else:
+                    operands.append(buffers[value])
+            ufunc(*operands, out=out if slot is None else buffers[slot])
+        return out
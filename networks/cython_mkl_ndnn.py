@@ -1,7 +1,7 @@
 from ctypes import *
 from ctypes.util import find_library
-from IPython import embed
 import numpy as np
+from activations import get_activation
 mkl = np.ctypeslib.load_library('libmkl_rt', '/opt/intel/compilers_and_libraries/linux/mkl/lib/intel64/')
 CblasRowMajor  = c_int(101)
 CblasColMajor  = c_int(102)
@@ -25,17 +25,23 @@ class Layer():
         self._weights = weight
         self._biases = np.atleast_2d(bias)
         self._activation = activation
+        self._act = get_activation(activation)
 
     def apply(self, input, output=None):
         A = input
         B = self._weights
         m, k = A.shape
         _, n = self._weights.shape
-        C = np.tile(self._biases, [m, 1])
-        #np.zeros_like(self.biases)
+        if output is None or output.shape != (m, n):
+            output = np.empty((m, n))
+        # Broadcast the biases into the output, dgemm adds to it
+        C = output
+        C[...] = self._biases
         mkl.cblas_dgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans, m, n, k, alpha, A, k, B, n ,beta, C, n)
         if self._activation == 'tanh':
             mkl.vdTanh(n*m, C, C)
+        else:
+            self._act.apply_inplace(C)
         return C
 
     def shape(self):
@@ -76,6 +82,7 @@ mkl.cblas_dgemm.argtypes = [
 ]
 
 if __name__ == '__main__':
+    from IPython import embed
     weights = np.array([[1.,2], [3,4]])
     biases = np.atleast_2d(np.array([5.,6]).T)
     act = 'tanh'
@@ -0,0 +1,99 @@
+""" Checking network inputs against the training domain
+
+A DomainGuard holds the feature bounds of a network as arrays and checks
+every input batch against them, with one vectorised comparison per bound.
+It keeps running counters of the rows outside the domain and of the
+values below and above the bounds per feature. What happens to rows
+outside the domain depends on the policy:
+
+    'flag'   only count them
+    'clamp'  count them and clip the input into the domain
+    'raise'  count them and raise a DomainError
+
+Guards are switched on per network with enable_domain_guard:
+
+    nn.enable_domain_guard('clamp')
+    nn.get_output(input)
+    print(nn.domain_stats())
+"""
+import threading
+import numpy as np
+
+POLICIES = ('flag', 'clamp', 'raise')
+
+class DomainError(Exception):
+    pass
+
+class DomainGuard():
+    """ Checks batches of input against per-feature bounds
+
+    low and high are in the column order of the checked input. NaN bounds
+    (unknown in the network file) are not checked.
+    """
+    def __init__(self, feature_names, low, high, policy='flag'):
+        if policy not in POLICIES:
+            raise Exception('Unknown domain policy {!s}, choose from {!s}'.format(policy, POLICIES))
+        self.policy = policy
+        self.feature_names = list(feature_names)
+        low = np.array(low, dtype='float64')
+        high = np.array(high, dtype='float64')
+        low[np.isnan(low)] = -np.inf
+        high[np.isnan(high)] = np.inf
+        self.low = low
+        self.high = high
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._rows = 0
+            self._rows_outside = 0
+            self._below = np.zeros(len(self.low), dtype='int64')
+            self._above = np.zeros(len(self.high), dtype='int64')
+
+    def outside(self, input):
+        """ Boolean mask of the rows of input outside the domain, without counting """
+        input = np.asarray(input)
+        return np.any((input < self.low) | (input > self.high), axis=1)
+
+    def apply(self, input):
+        """ Count the out-of-domain values of input and apply the policy
+
+        Returns the input, clipped into the domain for the 'clamp' policy.
+        """
+        input = np.asarray(input)
+        below = input < self.low
+        above = input > self.high
+        if not (below.any() or above.any()):
+            # Fast path: everything inside the domain
+            with self._lock:
+                self._rows += input.shape[0]
+            return input
+        below_count = np.count_nonzero(below, axis=0)
+        above_count = np.count_nonzero(above, axis=0)
+        n_outside = np.count_nonzero(np.any(below | above, axis=1))
+        with self._lock:
+            self._rows += input.shape[0]
+            self._rows_outside += n_outside
+            self._below += below_count
+            self._above += above_count
+        if self.policy == 'clamp':
+            return np.clip(input, self.low, self.high)
+        if self.policy == 'raise':
+            features = [name for name, count in zip(self.feature_names, below_count + above_count) if count > 0]
+            raise DomainError('{:d} rows outside the training domain in {!s}'.format(n_outside, features))
+        return input
+
+    def stats(self):
+        """ Counters since the last reset
+
+        below and above map every feature to the number of values below
+        its minimum or above its maximum.
+        """
+        with self._lock:
+            return {'policy': self.policy,
+                    'rows': self._rows,
+                    'rows_outside': self._rows_outside,
+                    'fraction_outside': self._rows_outside / self._rows if self._rows > 0 else 0.,
+                    'below': dict(zip(self.feature_names, self._below.tolist())),
+                    'above': dict(zip(self.feature_names, self._above.tolist()))}
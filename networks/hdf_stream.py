@@ -0,0 +1,98 @@
+""" Out-of-core evaluation of networks over the input table of an HDF5 store
+
+The input table is read in row chunks. Every network is evaluated once
+per chunk; the clipped result is derived from the unclipped one. Results
+are appended to the store chunk by chunk, so the job can be interrupted
+and resumed: networks continue from the rows they already have.
+"""
+import numpy as np
+import pandas as pd
+
+from run_model import clip_to_bounds
+
+NOCLIP_SUFFIX = '_noclip'
+
+def _n_rows(store, key):
+    """ Number of rows of key in store, 0 if it does not exist """
+    if key not in store:
+        return 0
+    storer = store.get_storer(key)
+    if storer.is_table:
+        return storer.nrows
+    return storer.shape[0]
+
+def _rows_done(store, key, noclip):
+    """ Number of rows that are stored for all outputs of a network
+
+    If an earlier run was interrupted between writing the clipped and the
+    unclipped output, the surplus rows of the longer one are removed.
+    """
+    keys = [key]
+    if noclip:
+        keys.append(key + NOCLIP_SUFFIX)
+    rows = [_n_rows(store, name) for name in keys]
+    done = min(rows)
+    for name, n_rows in zip(keys, rows):
+        if n_rows > done:
+            if not store.get_storer(name).is_table:
+                raise Exception('{!s} is not a table, remove it to regenerate'.format(name))
+            store.remove(name, start=done, stop=n_rows)
+    return done
+
+def stream_store(store_path, networks, input_key='megarun1/input',
+                 chunk_size=1000000, clip=True, noclip=True, verbose=True):
+    """ Evaluate networks on the input table of an HDF5 store, chunk by chunk
+
+    Args:
+        store_path: Path to the HDF5 store
+        networks:   Dict of output key -> network. The clipped output is
+                    stored under the key, the unclipped output under key +
+                    '_noclip'. Outputs are stored in table format.
+        input_key:  Key of the input table. The columns have to contain
+                    the features of all networks.
+        chunk_size: Number of rows read and evaluated at once.
+        clip:       Store the clipped output.
+        noclip:     Store the unclipped output.
+    """
+    if not (clip or noclip):
+        raise Exception('Nothing to store, set clip and/or noclip')
+    with pd.HDFStore(store_path) as store:
+        n_rows = _n_rows(store, input_key)
+        done = {}
+        for key, nn in networks.items():
+            if clip:
+                done[key] = _rows_done(store, key, noclip)
+            else:
+                done[key] = _n_rows(store, key + NOCLIP_SUFFIX)
+        start = min(list(done.values()) + [n_rows])
+        if verbose:
+            print('Evaluating {:d} networks on rows {:d} to {:d}'.format(len(networks), start, n_rows))
+
+        bound = False
+        while start < n_rows:
+            stop = min(start + chunk_size, n_rows)
+            input = store.select(input_key, start=start, stop=stop)
+            if not bound:
+                for nn in networks.values():
+                    nn.bind_feature_order(input.columns)
+                bound = True
+            for key, nn in networks.items():
+                if done[key] >= stop:
+                    continue
+                # Skip rows stored by an earlier run with a different chunk_size
+                skip = max(done[key] - start, 0)
+                chunk = input.iloc[skip:]
+                output = nn.predict_array(chunk.values, clip_low=False, clip_high=False)
+                if noclip:
+                    store.append(key + NOCLIP_SUFFIX,
+                                 pd.DataFrame(output, index=chunk.index, columns=nn._target_names))
+                if clip:
+                    low_bound, high_bound = nn._target_bounds
+                    output = clip_to_bounds(output, True, True, low_bound, high_bound)
+                    store.append(key,
+                                 pd.DataFrame(output, index=chunk.index, columns=nn._target_names))
+                done[key] = stop
+            store.flush()
+            if verbose:
+                print('Done {:d}/{:d} rows'.format(stop, n_rows))
+            start = stop
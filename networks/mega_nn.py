@@ -1,11 +1,10 @@
-from IPython import embed
-import pandas as pd
 import numpy as np
 import os
 import sys
 sys.path.insert(0,'..')
 
 from run_model import QuaLiKizDuoNN, QuaLiKizMultiNN, QuaLiKizNDNN, QuaLiKizComboNN
+from nn_io import load_collection
 
 simple_nns = ['efe_GB',
               'efi_GB',
@@ -26,11 +25,7 @@ simple_nns = ['efe_GB',
 #for name in simple_nns:
 #    nn = QuaLiKizNDNN.from_json('nns/nn_' + name + '.json')
 #    nns.append(nn)
-nn_dict = {}
-path = 'nns'
-for file_ in os.listdir(path):
-    if file_.endswith('.json'):
-        nn_dict[file_[3:-5]] = QuaLiKizNDNN.from_json(os.path.join(path, file_))
+nn_dict = load_collection('nns')
 #efe_fancy = 1. + (3.) / (2. + 1) + (5.) / (4. + 1)
 #efi_fancy = (2. * 3.) / (2. + 1) + (4. * 5.) / (4. + 1)
 
@@ -39,19 +34,19 @@ efe_GB_A = QuaLiKizComboNN('efe_GB_A', [nn_dict['efeETG_GB'],
                                         nn_dict['efiITG_GB_plus_efeITG_GB'],
                                         nn_dict['efiTEM_GB_div_efeTEM_GB'],
                                         nn_dict['efiTEM_GB_plus_efeTEM_GB']],
-                            lambda a, b, c, d, e: a + c / (b + 1) + e / (d + 1))
+                            'nn0 + nn2 / (nn1 + 1) + nn4 / (nn3 + 1)')
 efi_GB_A = QuaLiKizComboNN('efi_GB_A', [
                                         nn_dict['efiITG_GB_div_efeITG_GB'],
                                         nn_dict['efiITG_GB_plus_efeITG_GB'],
                                         nn_dict['efiTEM_GB_div_efeTEM_GB'],
                                         nn_dict['efiTEM_GB_plus_efeTEM_GB']],
-                            lambda b, c, d, e: (b * c) / (b + 1) + (d * e) / (d + 1))
+                            '(nn0 * nn1) / (nn0 + 1) + (nn2 * nn3) / (nn2 + 1)')
 efe_GB_C = QuaLiKizComboNN('efe_GB_C', [nn_dict['efi_GB_div_efe_GB'],
                                         nn_dict['efi_GB_plus_efe_GB']],
-                           lambda a, b: b / (a + 1))
+                           'nn1 / (nn0 + 1)')
 efi_GB_C = QuaLiKizComboNN('efi_GB_C', [nn_dict['efi_GB_div_efe_GB'],
                                         nn_dict['efi_GB_plus_efe_GB']],
-                           lambda a, b: (a * b) / (a + 1))
+                           '(nn0 * nn1) / (nn0 + 1)')
 efe_GB_D = nn_dict['efe_GB']
 efi_GB_D = nn_dict['efi_GB']
 nns = [
@@ -77,6 +72,8 @@ nn = QuaLiKizMultiNN(nns)
 
 #nn = QuaLiKizMultiNN(nns)
 if __name__ == '__main__':
+    from IPython import embed
+    import pandas as pd
     scann = 24
     input = pd.DataFrame()
     input['Ati'] = np.array(np.linspace(2,13, scann))
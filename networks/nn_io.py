@@ -0,0 +1,230 @@
+""" Reading and writing QuaLiKizNDNN networks
+
+Besides the JSON files written by QuaLiKiz-Tensorflow, networks can be
+stored in a compact binary container that can be memory-mapped:
+
+    8 bytes   magic b'QLKNNBIN'
+    uint32    format version
+    uint32    reserved
+    uint64    length of the header in bytes
+    header    UTF-8 JSON with all non-array entries of the nn_dict (names,
+              prescale, min/max, activations, metadata), the dtype of the
+              arrays and the offset and shape of every array
+    arrays    contiguous little-endian weight and bias blocks, each aligned
+              to 64 bytes
+
+All integers are little-endian. Loading a binary network maps the weight
+blocks with np.memmap, so no data is read until it is used.
+
+load_collection loads a whole directory of networks in parallel. JSON
+networks are converted once to binary files in a cache directory
+(~/.cache/qlknn/networks, or QLKNN_CACHE) keyed by the hash of their
+content, so later loads of unchanged networks only map the cached file.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import struct
+import numpy as np
+
+MAGIC = b'QLKNNBIN'
+VERSION = 1
+ALIGNMENT = 64
+BINARY_EXTENSION = '.qlknn'
+_preamble = struct.Struct('<8sIIQ')
+_array_key = re.compile(r'^layer\d+/(weights|biases)/')
+
+CACHE_DIR = os.environ.get('QLKNN_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'qlknn', 'networks'))
+
+def _is_array_key(name):
+    return _array_key.match(name) is not None
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def save_binary(nn_dict, path, dtype='float64'):
+    """ Write a nn_dict (as read from JSON) to a binary network file """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    header = {}
+    arrays = {}
+    for name, value in nn_dict.items():
+        if _is_array_key(name):
+            arrays[name] = np.ascontiguousarray(value, dtype=dtype)
+        else:
+            header[name] = value
+    # The offsets depend on the header length, which depends on the offsets.
+    # Reserve enough room by padding the offsets to a fixed width.
+    layout = {}
+    header['_binary'] = {'dtype': dtype.str, 'arrays': layout}
+    for name, array in arrays.items():
+        layout[name] = {'offset': 0, 'shape': list(array.shape)}
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    offset = _aligned(_preamble.size + len(header_bytes) + 20 * len(arrays))
+    for name in sorted(arrays):
+        layout[name]['offset'] = offset
+        offset = _aligned(offset + arrays[name].nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+
+    with open(path, 'wb') as file_:
+        file_.write(_preamble.pack(MAGIC, VERSION, 0, len(header_bytes)))
+        file_.write(header_bytes)
+        for name in sorted(arrays):
+            file_.write(b'\0' * (layout[name]['offset'] - file_.tell()))
+            file_.write(arrays[name].tobytes())
+
+def is_binary(path):
+    """ Check if path is a binary network file by its magic bytes """
+    with open(path, 'rb') as file_:
+        return file_.read(len(MAGIC)) == MAGIC
+
+def load_binary(path, mmap=True):
+    """ Read a binary network file into a nn_dict
+
+    The weights and biases are read-only np.memmap arrays if mmap is True,
+    and normal in-memory arrays otherwise.
+    """
+    with open(path, 'rb') as file_:
+        magic, version, _, header_length = _preamble.unpack(file_.read(_preamble.size))
+        if magic != MAGIC:
+            raise Exception('{!s} is not a binary network file'.format(path))
+        if version > VERSION:
+            raise Exception('Binary network file version {:d} not supported'.format(version))
+        nn_dict = json.loads(file_.read(header_length).decode('utf-8'))
+    binary = nn_dict.pop('_binary')
+    dtype = np.dtype(binary['dtype'])
+    if mmap:
+        # Map the file once, all arrays are views on this map
+        data = np.memmap(path, dtype='uint8', mode='r')
+    else:
+        data = np.fromfile(path, dtype='uint8')
+    for name, layout in binary['arrays'].items():
+        shape = tuple(layout['shape'])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        start = layout['offset']
+        nn_dict[name] = data[start:start + nbytes].view(dtype).reshape(shape)
+    return nn_dict
+
+def load_json(path):
+    with open(path) as file_:
+        return json.load(file_)
+
+def load_nn_dict(path, mmap=True):
+    """ Read a nn_dict from a JSON or binary network file """
+    if is_binary(path):
+        return load_binary(path, mmap=mmap)
+    return load_json(path)
+
+def load_network(path, **kwargs):
+    """ Create a QuaLiKizNDNN from a JSON or binary network file """
+    from run_model import QuaLiKizNDNN
+    return QuaLiKizNDNN(load_nn_dict(path), **kwargs)
+
+def json_to_binary(json_path, binary_path=None, dtype='float64'):
+    """ Convert a JSON network file to a binary network file """
+    if binary_path is None:
+        binary_path = os.path.splitext(json_path)[0] + BINARY_EXTENSION
+    save_binary(load_json(json_path), binary_path, dtype=dtype)
+    return binary_path
+
+def binary_to_json(binary_path, json_path=None):
+    """ Convert a binary network file back to a JSON network file """
+    if json_path is None:
+        json_path = os.path.splitext(binary_path)[0] + '.json'
+    nn_dict = load_binary(binary_path, mmap=False)
+    for name, value in nn_dict.items():
+        if _is_array_key(name):
+            nn_dict[name] = value.astype('float64').tolist()
+    with open(json_path, 'w') as file_:
+        json.dump(nn_dict, file_, sort_keys=True, indent=4, separators=(',', ': '))
+    return json_path
+
+def cache_path(json_path, cache_dir=None, dtype='float64'):
+    """ Path of the cached binary version of a JSON network file
+
+    The name is the hash of the file content, the binary format version and
+    the dtype, so a changed file or format never hits a stale entry.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    sha = hashlib.sha1()
+    sha.update('{:d}/{!s}/'.format(VERSION, np.dtype(dtype).str).encode('utf-8'))
+    with open(json_path, 'rb') as file_:
+        for block in iter(lambda: file_.read(1 << 20), b''):
+            sha.update(block)
+    return os.path.join(cache_dir, sha.hexdigest() + BINARY_EXTENSION)
+
+def cache_json(json_path, cache_dir=None, dtype='float64'):
+    """ Convert a JSON network file into the cache if it is not there yet
+
+    Returns the path of the cached binary network file.
+    """
+    path = cache_path(json_path, cache_dir=cache_dir, dtype=dtype)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write atomically, other processes might be loading the same network
+        tmp_path = '{!s}.{:d}.tmp'.format(path, os.getpid())
+        save_binary(load_json(json_path), tmp_path, dtype=dtype)
+        os.replace(tmp_path, path)
+    return path
+
+def collection_paths(paths, prefix='nn_'):
+    """ Name -> network file for a directory or a list of network files
+
+    The name is the file name without extension and without prefix. If
+    both a binary and a JSON file exist for a name, the binary one is used.
+    """
+    if isinstance(paths, str):
+        paths = [os.path.join(paths, file_) for file_ in sorted(os.listdir(paths))]
+    named_paths = {}
+    for path in paths:
+        name, ext = os.path.splitext(os.path.basename(path))
+        if ext not in ('.json', BINARY_EXTENSION):
+            continue
+        if prefix and name.startswith(prefix):
+            name = name[len(prefix):]
+        if ext == '.json' and named_paths.get(name, '').endswith(BINARY_EXTENSION):
+            continue
+        named_paths[name] = path
+    return named_paths
+
+def load_collection(paths, prefix='nn_', cache=True, cache_dir=None, workers=None, mmap=True, **kwargs):
+    """ Load a directory or list of network files into name -> QuaLiKizNDNN
+
+    With cache, JSON files missing from the cache are converted in
+    parallel worker processes (parsing JSON holds the GIL), after which all
+    networks are created from their binary files in a thread pool. Without
+    cache every JSON file is parsed in the thread pool. kwargs are passed
+    to QuaLiKizNDNN, e.g. layer_mode.
+    """
+    from run_model import QuaLiKizNDNN
+    named_paths = collection_paths(paths, prefix=prefix)
+    if cache:
+        json_names = [name for name, path in named_paths.items() if path.endswith('.json')]
+        cached = {name: cache_path(named_paths[name], cache_dir=cache_dir) for name in json_names}
+        missing = [name for name in json_names if not os.path.exists(cached[name])]
+        if len(missing) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for name, path in zip(missing, executor.map(cache_json, [named_paths[name] for name in missing],
+                                                            [cache_dir] * len(missing))):
+                    cached[name] = path
+        else:
+            for name in missing:
+                cached[name] = cache_json(named_paths[name], cache_dir=cache_dir)
+        named_paths.update(cached)
+    def load(path):
+        return QuaLiKizNDNN(load_nn_dict(path, mmap=mmap), **kwargs)
+    names = list(named_paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        nns = list(executor.map(load, [named_paths[name] for name in names]))
+    return dict(zip(names, nns))
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:]:
+        if is_binary(path):
+            print(binary_to_json(path))
+        else:
+            print(json_to_binary(path))
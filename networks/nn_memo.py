@@ -0,0 +1,207 @@
+""" Memoization of network evaluations for repeated inputs
+
+MemoizedNN wraps any QuaLiKiz network and caches its output per input
+row, in an LRU cache limited to a memory budget:
+
+    nn = MemoizedNN(QuaLiKizNDNN.from_json('nn.json'), max_bytes=64e6, quantum=1e-6)
+    output = nn.get_output(input, safe=True)
+    print(nn.stats())
+
+Every call first looks up the batch as a whole, so a batch that repeats
+an earlier one costs a single hash of its bytes. Otherwise it deduplicates
+the rows of the batch, looks up every distinct row, and evaluates only the
+misses with one call of the wrapped network. With quantum, inputs are
+rounded to a grid of that spacing (a scalar or one spacing per input
+column) and the network is evaluated on the grid point, so near-identical inputs share an entry and the output
+does not depend on which of them was seen first.
+
+The cache is keyed on the raw input columns of the call, so it assumes
+the wrapped network is not modified; call clear() if it is. Caches of
+get_output and predict_array and of different clipping settings are kept
+apart.
+
+A row lookup costs about a microsecond of Python, so the cache only pays
+off for networks that take longer than that per row, e.g. combinations
+of several networks or get_output with DataFrames, or when whole batches
+repeat. For a single small network on partly repeated batches the plain
+predict_array is faster.
+"""
+from collections import OrderedDict
+import threading
+import numpy as np
+from run_model import determine_settings, _output_labels, _pandas
+
+# Approximate bytes per entry besides the key and output, for the
+# OrderedDict node, the key tuple and the array header
+ENTRY_OVERHEAD = 200
+
+class MemoizedNN():
+    """ LRU cache around a QuaLiKiz network, see the module docstring
+
+    Attributes not defined here are looked up on the wrapped network.
+    """
+    def __init__(self, network, max_bytes=64e6, quantum=None):
+        self.network = network
+        self.max_bytes = max_bytes
+        if quantum is not None:
+            quantum = np.asarray(quantum, dtype='float64')
+            if np.any(quantum <= 0):
+                raise Exception('quantum should be positive')
+        self.quantum = quantum
+        self._entries = OrderedDict()
+        # Small integers for the namespaces, cheaper to hash in every key.
+        # Kept by clear(), so keys stored by a concurrent call stay apart
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name == 'network':
+            raise AttributeError(name)
+        return getattr(self.network, name)
+
+    def clear(self):
+        """ Empty the cache and reset the statistics """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._stats = {'calls': 0, 'rows': 0, 'unique_rows': 0,
+                           'hits': 0, 'misses': 0, 'evictions': 0, 'batch_hits': 0}
+
+    def stats(self):
+        """ Statistics since the last clear()
+
+        rows is the number of rows passed, unique_rows the number left after
+        deduplication within the batches. hits and misses count unique rows.
+        batch_hits counts the calls that repeated an earlier batch as a
+        whole; their rows count as unique rows and hits, as they are not
+        deduplicated.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.
+        return stats
+
+    def bind_feature_order(self, feature_names):
+        """ As QuaLiKizNN.bind_feature_order, clears the cache """
+        self.network.bind_feature_order(feature_names)
+        self.clear()
+
+    def predict_array(self, input, out=None, clip_low=True, clip_high=True):
+        """ Cached QuaLiKizNN.predict_array """
+        def predict(rows):
+            return self.network.predict_array(rows, clip_low=clip_low, clip_high=clip_high)
+        output = self._lookup(input, predict, ('predict_array', clip_low, clip_high))
+        if out is None:
+            return output
+        out[...] = output
+        return out
+
+    def get_output(self, input, output_pandas=True, clip_low=True, clip_high=True,
+                   low_bound=None, high_bound=None, safe=True):
+        """ Cached get_output of the wrapped network
+
+        The input is selected and ordered, and in safe mode low_bound and
+        high_bound are selected by target name, as by the wrapped network.
+        The rows and bounds are then passed to it as arrays.
+        """
+        nn_input, safe, _, _, low_bound, high_bound = \
+            determine_settings(self.network, input, safe, False, False, low_bound, high_bound)
+        bounds = tuple(None if bound is None else tuple(np.ravel(bound))
+                       for bound in [low_bound, high_bound])
+        def predict(rows):
+            return self.network.get_output(rows, output_pandas=False, clip_low=clip_low, clip_high=clip_high,
+                                           low_bound=low_bound, high_bound=high_bound, safe=False)
+        output = self._lookup(nn_input, predict, ('get_output', clip_low, clip_high, bounds))
+        if output_pandas is True:
+            output = _pandas().DataFrame(output, columns=_output_labels(self.network))
+        return output
+
+    def _lookup(self, input, predict, namespace):
+        input = np.atleast_2d(np.asarray(input, dtype='float64'))
+        n_rows, n_columns = input.shape
+        if self.quantum is None:
+            keys = np.ascontiguousarray(input)
+        else:
+            keys = np.ascontiguousarray(np.round(input / self.quantum).astype('int64'))
+        # A repeated batch is found with a single hash of all its rows.
+        # Batch keys are tuples with the shape, so they never equal a row key
+        batch_key = None
+        with self._lock:
+            namespace = self._namespaces.setdefault(namespace, len(self._namespaces))
+            if n_rows > 1:
+                batch_key = (namespace, keys.tobytes(), keys.shape)
+                output = self._entries.get(batch_key)
+                if output is not None:
+                    self._entries.move_to_end(batch_key)
+                    self._stats['calls'] += 1
+                    self._stats['batch_hits'] += 1
+                    self._stats['rows'] += n_rows
+                    self._stats['unique_rows'] += n_rows
+                    self._stats['hits'] += n_rows
+                    return output.copy()
+
+        # Deduplicate with a dict on the row bytes, cheaper than np.unique
+        # for the small batches this cache is meant for
+        unique_rows = {}
+        inverse = [unique_rows.setdefault(row.tobytes(), len(unique_rows)) for row in keys]
+        unique_keys = list(unique_rows)
+        first = np.empty(len(unique_keys), dtype='int64')
+        first[inverse[::-1]] = np.arange(n_rows - 1, -1, -1)
+
+        values = [None] * len(unique_keys)
+        missing = []
+        with self._lock:
+            entries = self._entries
+            for ii, key in enumerate(unique_keys):
+                value = entries.get((namespace, key))
+                if value is None:
+                    missing.append(ii)
+                else:
+                    entries.move_to_end((namespace, key))
+                    values[ii] = value
+            self._stats['calls'] += 1
+            self._stats['rows'] += n_rows
+            self._stats['unique_rows'] += len(unique_keys)
+            self._stats['hits'] += len(unique_keys) - len(missing)
+            self._stats['misses'] += len(missing)
+
+        if len(missing) > 0:
+            if self.quantum is None:
+                rows = input[first[missing]]
+            else:
+                rows = np.round(input[first[missing]] / self.quantum) * self.quantum
+            output = np.reshape(np.asarray(predict(rows), dtype='float64'), (len(missing), -1))
+            with self._lock:
+                for ii, value in zip(missing, output):
+                    value = value.copy()
+                    values[ii] = value
+                    self._store((namespace, unique_keys[ii]), value, len(unique_keys[ii]))
+                self._evict()
+
+        if len(values) == 0:
+            return np.empty((0, len(self.network._target_name_list)))
+        output = np.stack(values)
+        if len(values) < n_rows:
+            output = output[inverse]
+        if batch_key is not None:
+            with self._lock:
+                self._store(batch_key, output.copy(), len(batch_key[1]))
+                self._evict()
+        return output
+
+    def _store(self, key, value, key_bytes):
+        if key not in self._entries:
+            self._bytes += key_bytes + value.nbytes + ENTRY_OVERHEAD
+        self._entries[key] = value
+
+    def _evict(self):
+        """ Drop the least recently used entries until within max_bytes """
+        while self._bytes > self.max_bytes and len(self._entries) > 0:
+            key, value = self._entries.popitem(last=False)
+            self._bytes -= len(key[1]) + value.nbytes + ENTRY_OVERHEAD
+            self._stats['evictions'] += 1
@@ -0,0 +1,136 @@
+""" Opt-in per-stage profiling of get_output
+
+When enabled, every get_output call of a QuaLiKizNDNN, QuaLiKizComboNN
+or QuaLiKizMultiNN adds to counters per network class: the number of
+calls, rows and wall time, and the wall time per stage (determine_settings,
+prescale, apply_layers, descale, clip_to_bounds, to_pandas, ...). When
+disabled, get_output only checks ENABLED once per call. The evaluation of
+the underlying networks of a Combo or Multi network is counted as its
+'children' stage.
+
+    import nn_profiling
+    with nn_profiling.profile():
+        nn.get_output(input)
+    print(nn_profiling.to_frame())
+
+or switch it on for the whole process with nn_profiling.enable() and dump
+the counters with dump() or scrape them with to_prometheus().
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+ENABLED = False
+
+_lock = threading.Lock()
+_counters = {}
+
+class StageTimer():
+    """ Times the stages of a single call, merged into the counters by done() """
+    __slots__ = ('network', 'rows', 'start', 'last', 'laps')
+
+    def __init__(self, network, rows):
+        self.network = network
+        self.rows = rows
+        self.laps = []
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """ Attribute the time since the previous lap to stage """
+        now = time.perf_counter()
+        self.laps.append((stage, now - self.last))
+        self.last = now
+
+    def done(self):
+        total = time.perf_counter() - self.start
+        with _lock:
+            counter = _counters.get(self.network)
+            if counter is None:
+                counter = _counters[self.network] = {'calls': 0, 'rows': 0, 'time': 0., 'stages': {}}
+            counter['calls'] += 1
+            counter['rows'] += self.rows
+            counter['time'] += total
+            stages = counter['stages']
+            for stage, elapsed in self.laps:
+                if stage not in stages:
+                    stages[stage] = {'calls': 0, 'time': 0.}
+                stages[stage]['calls'] += 1
+                stages[stage]['time'] += elapsed
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+@contextmanager
+def profile(reset_counters=True):
+    """ Enable profiling within the with block """
+    global ENABLED
+    if reset_counters:
+        reset()
+    previous = ENABLED
+    ENABLED = True
+    try:
+        yield
+    finally:
+        ENABLED = previous
+
+def snapshot():
+    """ Copy of the counters: {network: {calls, rows, time, stages: {stage: {calls, time}}}} """
+    with _lock:
+        return {network: dict(counter, stages={stage: dict(values)
+                                               for stage, values in counter['stages'].items()})
+                for network, counter in _counters.items()}
+
+def dump(path):
+    """ Write the counters as JSON """
+    with open(path, 'w') as file_:
+        json.dump(snapshot(), file_, sort_keys=True, indent=4, separators=(',', ': '))
+
+def to_frame():
+    """ The counters as DataFrame indexed by (network, stage)
+
+    The time of the stages is also given as fraction of the total time
+    of the calls of that network.
+    """
+    import pandas as pd
+    records = []
+    for network, counter in snapshot().items():
+        for stage, values in counter['stages'].items():
+            records.append({'network': network, 'stage': stage,
+                            'calls': values['calls'], 'time': values['time'],
+                            'fraction': values['time'] / counter['time'] if counter['time'] else 0.})
+        records.append({'network': network, 'stage': 'total',
+                        'calls': counter['calls'], 'rows': counter['rows'],
+                        'time': counter['time'], 'fraction': 1.})
+    if len(records) == 0:
+        return pd.DataFrame(columns=['calls', 'rows', 'time', 'fraction'])
+    return pd.DataFrame(records).set_index(['network', 'stage'])
+
+def to_prometheus(prefix='qlknn'):
+    """ The counters in the Prometheus text exposition format """
+    lines = []
+    counters = snapshot()
+    for name, help in [('calls', 'get_output calls'), ('rows', 'rows evaluated by get_output'),
+                       ('seconds', 'wall time of get_output')]:
+        metric = '{!s}_{!s}_total'.format(prefix, name)
+        lines.append('# HELP {!s} {!s}'.format(metric, help))
+        lines.append('# TYPE {!s} counter'.format(metric))
+        key = 'time' if name == 'seconds' else name
+        for network, counter in sorted(counters.items()):
+            lines.append('{!s}{{network="{!s}"}} {!r}'.format(metric, network, counter[key]))
+    metric = '{!s}_stage_seconds_total'.format(prefix)
+    lines.append('# HELP {!s} wall time per stage of get_output'.format(metric))
+    lines.append('# TYPE {!s} counter'.format(metric))
+    for network, counter in sorted(counters.items()):
+        for stage, values in sorted(counter['stages'].items()):
+            lines.append('{!s}{{network="{!s}",stage="{!s}"}} {!r}'.format(metric, network, stage, values['time']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,156 @@
+""" Numba backend for QuaLiKizNDNN
+
+For every topology (layer sizes and activations) the source of a fused
+kernel is generated: prescale, all layers, descale and clip in a single
+loop over the rows, with all loop bounds fixed. The source is written to
+the cache directory and imported from there, so numba can cache the
+compiled kernel on disk (cache=True only works for functions defined in a
+file). Networks with the same topology share one kernel.
+
+The kernel does not hold the GIL, so threads evaluate in parallel.
+"""
+import hashlib
+import importlib.util
+import os
+import sys
+import threading
+import numpy as np
+# Raises ImportError without numba, QuaLiKizNDNN then falls back to classic
+import numba
+
+CACHE_DIR = os.environ.get('QLKNN_NUMBA_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'qlknn', 'numba'))
+
+_kernels = {}
+_kernels_lock = threading.Lock()
+
+_activation_source = {
+    'tanh': '{0}[jj] = tanh({0}[jj])',
+    'relu': 'if not {0}[jj] > 0.0:\n                {0}[jj] = 0.0',
+    'none': None,
+}
+
+def generate_kernel_source(sizes, activations):
+    """ Python source of the fused kernel for a network topology
+
+    sizes are the number of features followed by the number of neurons of
+    every layer, activations the activation of every layer.
+    """
+    n_layers = len(activations)
+    if len(sizes) != n_layers + 1:
+        raise Exception('Need {:d} sizes for {:d} layers'.format(n_layers + 1, n_layers))
+    for activation in activations:
+        if activation not in _activation_source:
+            raise Exception('Activation {!s} not supported by the numba backend'.format(activation))
+    layer_args = ', '.join('weights_{0:d}, biases_{0:d}'.format(ii) for ii in range(n_layers))
+    lines = [
+        '# Generated by numba_ndnn.py, do not edit',
+        '# Topology: ' + ' -> '.join('{:d}'.format(size) for size in sizes),
+        '# Activations: ' + ', '.join(activations),
+        'from math import tanh',
+        'import numpy as np',
+        'from numba import njit',
+        '',
+        '@njit(cache=True, nogil=True)',
+        'def kernel(input, {!s}, feature_factor, feature_bias, target_factor, target_bias,'.format(layer_args),
+        '           clip_low, clip_high, low_bound, high_bound, out):',
+    ]
+    for ii, size in enumerate(sizes):
+        lines.append('    x_{:d} = np.empty({:d})'.format(ii, size))
+    lines += [
+        '    for row in range(input.shape[0]):',
+        '        for jj in range({:d}):'.format(sizes[0]),
+        '            x_0[jj] = input[row, jj] * feature_factor[jj] + feature_bias[jj]',
+    ]
+    for ii, activation in enumerate(activations):
+        src, dst = 'x_{:d}'.format(ii), 'x_{:d}'.format(ii + 1)
+        lines += [
+            '        # Layer {:d}: {:d} -> {:d}, {!s}'.format(ii + 1, sizes[ii], sizes[ii + 1], activation),
+            '        for jj in range({:d}):'.format(sizes[ii + 1]),
+            '            {!s}[jj] = biases_{:d}[jj]'.format(dst, ii),
+            '        for kk in range({:d}):'.format(sizes[ii]),
+            '            value = {!s}[kk]'.format(src),
+            '            for jj in range({:d}):'.format(sizes[ii + 1]),
+            '                {!s}[jj] += value * weights_{:d}[kk, jj]'.format(dst, ii),
+        ]
+        if _activation_source[activation] is not None:
+            lines += [
+                '        for jj in range({:d}):'.format(sizes[ii + 1]),
+                '            ' + _activation_source[activation].format(dst),
+            ]
+    lines += [
+        '        for jj in range({:d}):'.format(sizes[-1]),
+        '            value = (x_{:d}[jj] - target_bias[jj]) / target_factor[jj]'.format(n_layers),
+        '            if clip_low and value < low_bound[jj]:',
+        '                value = low_bound[jj]',
+        '            if clip_high and value > high_bound[jj]:',
+        '                value = high_bound[jj]',
+        '            out[row, jj] = value',
+        '',
+    ]
+    return '\n'.join(lines)
+
+def get_kernel(sizes, activations, cache_dir=None):
+    """ The compiled fused kernel for a topology, generated if needed """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    source = generate_kernel_source(sizes, activations)
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    with _kernels_lock:
+        if key in _kernels:
+            return _kernels[key]
+        module_name = 'qlknn_kernel_' + key
+        path = os.path.join(cache_dir, module_name + '.py')
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write atomically, other processes might be loading the same kernel
+            tmp_path = '{!s}.{:d}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as file_:
+                file_.write(source)
+            os.replace(tmp_path, path)
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        # numba looks up the module by name when loading from its cache
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        _kernels[key] = module.kernel
+        return module.kernel
+
+class Network():
+    """ A full QuaLiKizNDNN evaluated by a fused numba kernel
+
+    Takes the same arguments as qlknn.Network. The kernel is compiled (or
+    loaded from the on-disk cache) on construction.
+    """
+    def __init__(self, weights, biases, activations, feature_factor, feature_bias,
+                 target_factor, target_bias, cache_dir=None):
+        self._weights = [np.ascontiguousarray(weight, dtype='float64') for weight in weights]
+        self._biases = [np.ascontiguousarray(np.ravel(bias), dtype='float64') for bias in biases]
+        self._activations = list(activations)
+        sizes = [self._weights[0].shape[0]] + [weight.shape[1] for weight in self._weights]
+        self._sizes = sizes
+        self._kernel = get_kernel(sizes, self._activations, cache_dir=cache_dir)
+        args = []
+        for weight, bias in zip(self._weights, self._biases):
+            args += [weight, bias]
+        args += [np.ascontiguousarray(array, dtype='float64')
+                 for array in [feature_factor, feature_bias, target_factor, target_bias]]
+        self._args = tuple(args)
+        self._no_bound = np.zeros(sizes[-1])
+        # Compile now, not on the first evaluation
+        self.apply(np.zeros((1, sizes[0])))
+
+    def apply(self, input, out=None, clip_low=False, clip_high=False, low_bound=None, high_bound=None):
+        """ Prescale, apply all layers, descale and optionally clip into out """
+        input = np.asarray(input, dtype='float64')
+        if input.ndim != 2 or input.shape[1] != self._sizes[0]:
+            raise Exception('input should have shape (n, {:d})'.format(self._sizes[0]))
+        if out is None:
+            out = np.empty((input.shape[0], self._sizes[-1]))
+        if low_bound is None:
+            low_bound = self._no_bound
+        if high_bound is None:
+            high_bound = self._no_bound
+        self._kernel(input, *self._args, bool(clip_low), bool(clip_high),
+                     low_bound, high_bound, out)
+        return out
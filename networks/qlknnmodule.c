@@ -26,13 +26,46 @@
 
 static PyObject *ErrorObject;
 
+/* Keep in sync with the codes in activations.py */
 enum act {
-    TANH,
-    RELU,
-    NONE,
+    TANH = 0,
+    RELU = 1,
+    NONE = 2,
     ERR
 };
 
+static enum act
+activation_from_string(const char *name)
+{
+    if (!strcmp(name, "tanh"))
+        return TANH;
+    else if (!strcmp(name, "relu"))
+        return RELU;
+    else if (!strcmp(name, "none"))
+        return NONE;
+    PyErr_Format(PyExc_ValueError, "Unknown activation function %s", name);
+    return ERR;
+}
+
+static void
+apply_activation(enum act activation, MKL_INT size, double *data)
+{
+    MKL_INT ii;
+    switch(activation) {
+        case TANH:
+            vdTanh(size, data, data);
+            break;
+        case RELU:
+            /* In-place, no temporary array of zeros */
+            for (ii = 0; ii < size; ii++)
+                if (!(data[ii] > 0.0))
+                    data[ii] = 0.0;
+            break;
+        default:
+            break;
+    }
+}
+
 typedef struct {
     PyObject_HEAD
     PyObject            *x_attr;        /* Attributes dictionary */
@@ -116,13 +149,8 @@ Layer_init(LayerObject *self, PyObject *args, PyObject *kwds)
     //self->_biases = _biases;
     //Py_XDECREF(tmp);
 
-    if (!strcmp(_activation, "tanh"))
-        self->_activation = TANH;
-    else if (!strcmp(_activation, "relu"))
-        self->_activation = RELU;
-    else if (!strcmp(_activation, "none"))
-        self->_activation = NONE;
-    else
+    self->_activation = activation_from_string(_activation);
+    if (self->_activation == ERR)
         return -1;
     //tmp = self->_activation;
     //Py_INCREF(_activation);
@@ -215,28 +243,17 @@ Layer_apply(LayerObject *self, PyObject *args)
     }
 
 
+    if (self->_activation == ERR) {
+        PyErr_SetString(PyExc_AttributeError, "_activation has an unknown value");
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
     cblas_dgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
                 m, n, k, alpha, A, k, B, n, beta, C, n);
     //mode = VML_HA;
     //vmlSetMode(VML_LA);
-    double *zeros;
-    switch(self->_activation) {
-        case TANH:
-            vdTanh(m*n, C, C);
-            break;
-        case NONE:
-            break;
-        case RELU:
-            zeros = (double *)calloc( m*n, sizeof( double ) );
-            for (int ii = 0; ii < m*n; ii++)
-                zeros[ii] = 0.0;
-            vdFmax(m*n, C, zeros, C);
-            free(zeros);
-            break;
-        default:
-            PyErr_SetString(PyExc_AttributeError, "_activation has an unknown value");
-            return NULL;
-    }
+    apply_activation(self->_activation, m*n, C);
+    Py_END_ALLOW_THREADS
     Py_INCREF(out);
     return out;
 }
@@ -313,6 +330,8 @@ Layer_get_activation(LayerObject *self, void *closure)
 static int
 Layer_set_activation(LayerObject *self, PyObject *value, void *closure)
 {
+    enum act activation;
+
     if (value == NULL) {
         PyErr_SetString(PyExc_TypeError, "Cannot delete the _activation attribute");
         return -1;
@@ -324,17 +343,10 @@ Layer_set_activation(LayerObject *self, PyObject *value, void *closure)
         return -1;
     }
 
-    if (!PyUnicode_CompareWithASCIIString(value, "tanh"))
-        self->_activation = TANH;
-    else if (!PyUnicode_CompareWithASCIIString(value, "relu"))
-        self->_activation = RELU;
-    else if (!PyUnicode_CompareWithASCIIString(value, "none"))
-        self->_activation = NONE;
-    else
-    {
-        PyErr_SetString(PyExc_ValueError, "Unkown activation function, cannot set");
+    activation = activation_from_string(PyUnicode_AsUTF8(value));
+    if (activation == ERR)
         return -1;
-    }
+    self->_activation = activation;
 
     return 0;
 }
@@ -395,6 +407,425 @@ static PyTypeObject Layer_Type = {
 };
 /* --------------------------------------------------------------------- */
 
+/* Network objects
+
+   A Network owns the weights, biases and activations of all layers and
+   the prescale and descale vectors, and evaluates the whole network in
+   one call:
+
+       out = (layers((input * feature_factor) + feature_bias) - target_bias) / target_factor
+
+   Rows are evaluated in blocks of block_rows. The hidden layers of a block
+   ping-pong between two buffers of block_rows x widest layer, the output
+   layer is written straight into out. The GIL is released during the
+   evaluation, so several Python threads can evaluate at the same time.
+   The first thread uses the workspace owned by the Network; while it is
+   busy, other threads get a temporary workspace. */
+
+typedef struct {
+    PyObject_HEAD
+    PyObject            *_weights;      /* Tuple of C-contiguous double arrays */
+    PyObject            *_biases;
+    PyArrayObject       *_feature_factor;
+    PyArrayObject       *_feature_bias;
+    PyArrayObject       *_target_factor;
+    PyArrayObject       *_target_bias;
+    Py_ssize_t          _n_layers;
+    enum act            *_activations;
+    MKL_INT             *_sizes;        /* Input width, then width of every layer */
+    double              **_weight_data;
+    double              **_bias_data;
+    Py_ssize_t          _block_rows;
+    MKL_INT             _max_width;
+    double              *_workspace;
+    int                 _busy;          /* The workspace is in use */
+    int                 _active;        /* Number of running evaluations */
+} NetworkObject;
+
+static PyTypeObject Network_Type;
+
+static void
+Network_clear(NetworkObject *self)
+{
+    Py_CLEAR(self->_weights);
+    Py_CLEAR(self->_biases);
+    Py_CLEAR(self->_feature_factor);
+    Py_CLEAR(self->_feature_bias);
+    Py_CLEAR(self->_target_factor);
+    Py_CLEAR(self->_target_bias);
+    PyMem_Free(self->_activations);
+    PyMem_Free(self->_sizes);
+    PyMem_Free(self->_weight_data);
+    PyMem_Free(self->_bias_data);
+    if (self->_workspace != NULL)
+        mkl_free(self->_workspace);
+    self->_activations = NULL;
+    self->_sizes = NULL;
+    self->_weight_data = NULL;
+    self->_bias_data = NULL;
+    self->_workspace = NULL;
+    self->_n_layers = 0;
+}
+
+static PyObject *
+Network_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    NetworkObject *self;
+    self = (NetworkObject *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+    /* tp_alloc zeroes all fields */
+    return (PyObject *)self;
+}
+
+static PyArrayObject *
+vector_from_object(PyObject *object, MKL_INT size, const char *name)
+{
+    PyArrayObject *vector;
+    vector = (PyArrayObject *)PyArray_FROM_OTF(object, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (vector == NULL)
+        return NULL;
+    if (PyArray_SIZE(vector) != size) {
+        PyErr_Format(PyExc_ValueError, "%s has size %zd, expected %zd",
+                     name, (Py_ssize_t)PyArray_SIZE(vector), (Py_ssize_t)size);
+        Py_DECREF(vector);
+        return NULL;
+    }
+    return vector;
+}
+
+static int
+Network_init(NetworkObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"weights", "biases", "activations",
+                             "feature_factor", "feature_bias",
+                             "target_factor", "target_bias",
+                             "block_rows", NULL};
+    PyObject *weights, *biases, *activations;
+    PyObject *feature_factor, *feature_bias, *target_factor, *target_bias;
+    PyObject *item;
+    PyArrayObject *array;
+    Py_ssize_t block_rows = 1024, n_layers, ii;
+    MKL_INT max_width;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOOO|n", kwlist,
+            &weights, &biases, &activations,
+            &feature_factor, &feature_bias, &target_factor, &target_bias,
+            &block_rows))
+        return -1;
+    if (self->_active > 0) {
+        PyErr_SetString(PyExc_RuntimeError, "Cannot re-initialize a Network that is being evaluated");
+        return -1;
+    }
+    Network_clear(self);
+
+    n_layers = PySequence_Size(weights);
+    if (n_layers < 1) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_ValueError, "A Network needs at least one layer");
+        return -1;
+    }
+    if (PySequence_Size(biases) != n_layers || PySequence_Size(activations) != n_layers) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_ValueError, "weights, biases and activations should have the same length");
+        return -1;
+    }
+    if (block_rows < 1) {
+        PyErr_SetString(PyExc_ValueError, "block_rows should be positive");
+        return -1;
+    }
+    self->_n_layers = n_layers;
+    self->_block_rows = block_rows;
+    self->_weights = PyTuple_New(n_layers);
+    self->_biases = PyTuple_New(n_layers);
+    self->_activations = PyMem_Malloc(n_layers * sizeof(enum act));
+    self->_sizes = PyMem_Malloc((n_layers + 1) * sizeof(MKL_INT));
+    self->_weight_data = PyMem_Malloc(n_layers * sizeof(double *));
+    self->_bias_data = PyMem_Malloc(n_layers * sizeof(double *));
+    if (self->_weights == NULL || self->_biases == NULL ||
+        self->_activations == NULL || self->_sizes == NULL ||
+        self->_weight_data == NULL || self->_bias_data == NULL) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+
+    for (ii = 0; ii < n_layers; ii++) {
+        /* Copies only if the array is not C-contiguous double already */
+        item = PySequence_GetItem(weights, ii);
+        if (item == NULL)
+            goto fail;
+        array = (PyArrayObject *)PyArray_FROM_OTF(item, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+        Py_DECREF(item);
+        if (array == NULL)
+            goto fail;
+        PyTuple_SET_ITEM(self->_weights, ii, (PyObject *)array);
+        if (PyArray_NDIM(array) != 2) {
+            PyErr_Format(PyExc_ValueError, "weights of layer %zd are not 2D", ii + 1);
+            goto fail;
+        }
+        if (ii == 0)
+            self->_sizes[0] = PyArray_DIM(array, 0);
+        else if (PyArray_DIM(array, 0) != self->_sizes[ii]) {
+            PyErr_Format(PyExc_ValueError, "weights of layer %zd do not match the previous layer", ii + 1);
+            goto fail;
+        }
+        self->_sizes[ii + 1] = PyArray_DIM(array, 1);
+        self->_weight_data[ii] = (double *)PyArray_DATA(array);
+
+        item = PySequence_GetItem(biases, ii);
+        if (item == NULL)
+            goto fail;
+        array = vector_from_object(item, self->_sizes[ii + 1], "biases");
+        Py_DECREF(item);
+        if (array == NULL)
+            goto fail;
+        PyTuple_SET_ITEM(self->_biases, ii, (PyObject *)array);
+        self->_bias_data[ii] = (double *)PyArray_DATA(array);
+
+        item = PySequence_GetItem(activations, ii);
+        if (item == NULL)
+            goto fail;
+        if (!PyUnicode_Check(item)) {
+            PyErr_SetString(PyExc_TypeError, "activations should be strings");
+            Py_DECREF(item);
+            goto fail;
+        }
+        self->_activations[ii] = activation_from_string(PyUnicode_AsUTF8(item));
+        Py_DECREF(item);
+        if (self->_activations[ii] == ERR)
+            goto fail;
+    }
+
+    self->_feature_factor = vector_from_object(feature_factor, self->_sizes[0], "feature_factor");
+    if (self->_feature_factor == NULL)
+        goto fail;
+    self->_feature_bias = vector_from_object(feature_bias, self->_sizes[0], "feature_bias");
+    if (self->_feature_bias == NULL)
+        goto fail;
+    self->_target_factor = vector_from_object(target_factor, self->_sizes[n_layers], "target_factor");
+    if (self->_target_factor == NULL)
+        goto fail;
+    self->_target_bias = vector_from_object(target_bias, self->_sizes[n_layers], "target_bias");
+    if (self->_target_bias == NULL)
+        goto fail;
+
+    /* The output layer is written to out, so it needs no buffer */
+    max_width = 0;
+    for (ii = 0; ii < n_layers; ii++)
+        if (self->_sizes[ii] > max_width)
+            max_width = self->_sizes[ii];
+    self->_max_width = max_width;
+    self->_workspace = mkl_malloc(2 * block_rows * max_width * sizeof(double), 64);
+    if (self->_workspace == NULL) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+    return 0;
+
+ fail:
+    Network_clear(self);
+    return -1;
+}
+
+static void
+Network_dealloc(NetworkObject *self)
+{
+    Network_clear(self);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+/* Evaluate m rows of input into out. Does not touch Python objects,
+   so it can run without the GIL. */
+static void
+network_evaluate(NetworkObject *self, MKL_INT m, const double *input, double *out, double *workspace)
+{
+    MKL_INT start, rows, ii, jj, k, n;
+    Py_ssize_t layer;
+    double *buffers[2], *src, *dst;
+    const double *feature_factor = PyArray_DATA(self->_feature_factor);
+    const double *feature_bias = PyArray_DATA(self->_feature_bias);
+    const double *target_factor = PyArray_DATA(self->_target_factor);
+    const double *target_bias = PyArray_DATA(self->_target_bias);
+    int n_threads;
+
+    /* Parallelism comes from the calling threads, keep MKL sequential */
+    n_threads = mkl_set_num_threads_local(1);
+    buffers[0] = workspace;
+    buffers[1] = workspace + self->_block_rows * self->_max_width;
+    for (start = 0; start < m; start += self->_block_rows) {
+        rows = m - start < self->_block_rows ? m - start : self->_block_rows;
+
+        k = self->_sizes[0];
+        src = buffers[0];
+        for (ii = 0; ii < rows; ii++)
+            for (jj = 0; jj < k; jj++)
+                src[ii*k + jj] = input[(start + ii)*k + jj] * feature_factor[jj] + feature_bias[jj];
+
+        dst = src;
+        for (layer = 0; layer < self->_n_layers; layer++) {
+            k = self->_sizes[layer];
+            n = self->_sizes[layer + 1];
+            if (layer == self->_n_layers - 1)
+                dst = out + start*n;
+            else
+                dst = buffers[(layer + 1) % 2];
+            for (ii = 0; ii < rows; ii++)
+                cblas_dcopy(n, self->_bias_data[layer], 1, dst + ii*n, 1);
+            cblas_dgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
+                        rows, n, k, 1.0, src, k, self->_weight_data[layer], n, 1.0, dst, n);
+            apply_activation(self->_activations[layer], rows*n, dst);
+            src = dst;
+        }
+
+        n = self->_sizes[self->_n_layers];
+        for (ii = 0; ii < rows; ii++)
+            for (jj = 0; jj < n; jj++)
+                dst[ii*n + jj] = (dst[ii*n + jj] - target_bias[jj]) / target_factor[jj];
+    }
+    mkl_set_num_threads_local(n_threads);
+}
+
+static PyObject *
+Network_apply(NetworkObject *self, PyObject *args)
+{
+    PyObject *input_object, *out_object = Py_None;
+    PyArrayObject *input, *out;
+    npy_intp dims[2];
+    double *workspace;
+    int own_workspace;
+
+    if (!PyArg_ParseTuple(args, "O|O:apply", &input_object, &out_object))
+        return NULL;
+    if (self->_n_layers == 0) {
+        PyErr_SetString(PyExc_RuntimeError, "Network is not initialized");
+        return NULL;
+    }
+
+    input = (PyArrayObject *)PyArray_FROM_OTF(input_object, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (input == NULL)
+        return NULL;
+    if (PyArray_NDIM(input) != 2 || PyArray_DIM(input, 1) != self->_sizes[0]) {
+        PyErr_Format(PyExc_ValueError, "input should have shape (n, %zd)", (Py_ssize_t)self->_sizes[0]);
+        Py_DECREF(input);
+        return NULL;
+    }
+    dims[0] = PyArray_DIM(input, 0);
+    dims[1] = self->_sizes[self->_n_layers];
+    if (out_object == Py_None) {
+        out = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+        if (out == NULL) {
+            Py_DECREF(input);
+            return NULL;
+        }
+    } else {
+        if (!PyArray_Check(out_object) ||
+            PyArray_TYPE((PyArrayObject *)out_object) != NPY_DOUBLE ||
+            !PyArray_ISCARRAY((PyArrayObject *)out_object) ||
+            PyArray_NDIM((PyArrayObject *)out_object) != 2 ||
+            PyArray_DIM((PyArrayObject *)out_object, 0) != dims[0] ||
+            PyArray_DIM((PyArrayObject *)out_object, 1) != dims[1]) {
+            PyErr_Format(PyExc_ValueError,
+                         "out should be a writeable C-contiguous double array of shape (%zd, %zd)",
+                         (Py_ssize_t)dims[0], (Py_ssize_t)dims[1]);
+            Py_DECREF(input);
+            return NULL;
+        }
+        out = (PyArrayObject *)out_object;
+        Py_INCREF(out);
+    }
+
+    /* The flags are only touched while holding the GIL */
+    own_workspace = !self->_busy;
+    if (own_workspace) {
+        self->_busy = 1;
+        workspace = self->_workspace;
+    } else {
+        workspace = mkl_malloc(2 * self->_block_rows * self->_max_width * sizeof(double), 64);
+        if (workspace == NULL) {
+            Py_DECREF(input);
+            Py_DECREF(out);
+            return PyErr_NoMemory();
+        }
+    }
+    self->_active++;
+
+    Py_BEGIN_ALLOW_THREADS
+    network_evaluate(self, dims[0], PyArray_DATA(input), PyArray_DATA(out), workspace);
+    Py_END_ALLOW_THREADS
+
+    self->_active--;
+    if (own_workspace)
+        self->_busy = 0;
+    else
+        mkl_free(workspace);
+    Py_DECREF(input);
+    return (PyObject *)out;
+}
+
+static PyMethodDef Network_methods[] = {
+    {"apply",            (PyCFunction)Network_apply,  METH_VARARGS,
+        PyDoc_STR("apply(input, out=None) -> out\n\n"
+                  "Prescale input, apply all layers and descale into out")},
+    {NULL,              NULL}           /* sentinel */
+};
+
+static PyMemberDef Network_members[] = {
+    {"_weights", T_OBJECT_EX, offsetof(NetworkObject, _weights), READONLY,
+     "weights of all layers"},
+    {"_biases", T_OBJECT_EX, offsetof(NetworkObject, _biases), READONLY,
+     "biases of all layers"},
+    {"block_rows", T_PYSSIZET, offsetof(NetworkObject, _block_rows), READONLY,
+     "number of rows evaluated at once"},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject Network_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "qlknnmodule.Network",      /*tp_name*/
+    sizeof(NetworkObject),      /*tp_basicsize*/
+    0,                          /*tp_itemsize*/
+    /* methods */
+    (destructor)Network_dealloc, /*tp_dealloc*/
+    0,                          /*tp_print*/
+    0,                          /*tp_getattr*/
+    0,                          /*tp_setattr*/
+    0,                          /*tp_reserved*/
+    0,                          /*tp_repr*/
+    0,                          /*tp_as_number*/
+    0,                          /*tp_as_sequence*/
+    0,                          /*tp_as_mapping*/
+    0,                          /*tp_hash*/
+    0,                          /*tp_call*/
+    0,                          /*tp_str*/
+    0,                          /*tp_getattro*/
+    0,                          /*tp_setattro*/
+    0,                          /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+    "Network(weights, biases, activations, feature_factor, feature_bias,\n"
+    "        target_factor, target_bias, block_rows=1024)", /*tp_doc*/
+    0,                          /*tp_traverse*/
+    0,                          /*tp_clear*/
+    0,                          /*tp_richcompare*/
+    0,                          /*tp_weaklistoffset*/
+    0,                          /*tp_iter*/
+    0,                          /*tp_iternext*/
+    Network_methods,            /*tp_methods*/
+    Network_members,            /*tp_members*/
+    0,                          /*tp_getset*/
+    0,                          /*tp_base*/
+    0,                          /*tp_dict*/
+    0,                          /*tp_descr_get*/
+    0,                          /*tp_descr_set*/
+    0,                          /*tp_dictoffset*/
+    (initproc)Network_init,     /*tp_init*/
+    0,                          /*tp_alloc*/
+    Network_new,                /*tp_new*/
+    0,                          /*tp_free*/
+    0,                          /*tp_is_gc*/
+};
+
+/* --------------------------------------------------------------------- */
+
 /* Function of two integers returning integer */
 
 PyDoc_STRVAR(qlknn_foo_doc,
@@ -496,6 +927,8 @@ PyInit_qlknn(void)
     PyObject* m;
     if (PyType_Ready(&Layer_Type) < 0)
         return NULL;
+    if (PyType_Ready(&Network_Type) < 0)
+        return NULL;
 
     m = PyModule_Create(&qlknnmodule);
     if (m == NULL)
@@ -503,6 +936,8 @@ PyInit_qlknn(void)
 
     Py_INCREF(&Layer_Type);
     PyModule_AddObject(m, "Layer", (PyObject *)&Layer_Type);
+    Py_INCREF(&Network_Type);
+    PyModule_AddObject(m, "Network", (PyObject *)&Network_Type);
 
     /* Add some symbolic constants to the module */
     if (ErrorObject == NULL) {
@@ -513,6 +948,11 @@ PyInit_qlknn(void)
     Py_INCREF(ErrorObject);
     PyModule_AddObject(m, "error", ErrorObject);
 
+    /* Activation codes, as in the registry of activations.py */
+    PyModule_AddIntConstant(m, "ACT_TANH", TANH);
+    PyModule_AddIntConstant(m, "ACT_RELU", RELU);
+    PyModule_AddIntConstant(m, "ACT_NONE", NONE);
+
     ///* Add Str */
     //if (PyType_Ready(&Str_Type) < 0)
     //    goto fail;
@@ -1,23 +1,527 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
+import hashlib
 import json
 import numpy as np
-from IPython import embed
 import os
+import sys
 from collections import OrderedDict
-import pandas as pd
+import threading
 from warnings import warn
+from activations import ACTIVATIONS, get_activation
+from combo_recipe import Recipe
+from domain_guard import DomainGuard
+import nn_profiling
 def sigm_tf(x):
     return 1./(1 + np.exp(-1 * x))
 
 #def sigm(x):
 #    return 2./(1 + np.exp(-2 * x)) - 1
 
+# Default number of rows per tile in predict_chunked. A tile of a 3x96
+# network needs about 3 MB of intermediate results, so it stays in cache.
+CHUNK_SIZE = 4096
+
 def flatten(l):
     return [item for sublist in l for item in sublist]
 
-class QuaLiKizMultiNN():
+def _pandas():
+    """ Import pandas on first use
+
+    Evaluating a QuaLiKizNDNN on arrays does not need pandas, so it is only
+    imported for DataFrame input and output and for the wrapper networks.
+    """
+    import pandas
+    return pandas
+
+def _is_dataframe(input):
+    # If pandas is not imported yet, input cannot be a DataFrame
+    pandas = sys.modules.get('pandas')
+    return pandas is not None and isinstance(input, pandas.DataFrame)
+
+class _LazySeries():
+    """ Attribute stored as array, converted to a pandas.Series on first access
+
+    The values live in instance._arrays[name]. Names are a Series with the
+    default index, other values are indexed by the names in index_name.
+    Assigning a Series replaces the values.
+    """
+    def __init__(self, name, index_name=None):
+        self._name = name
+        self._index_name = index_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance.__dict__['_series' + self._name]
+        except KeyError:
+            pass
+        pd = _pandas()
+        if self._index_name is None:
+            series = pd.Series(instance._arrays[self._name])
+        else:
+            series = pd.Series(instance._arrays[self._name], index=instance._arrays[self._index_name])
+        instance.__dict__['_series' + self._name] = series
+        return series
+
+    def __set__(self, instance, value):
+        instance.__dict__['_series' + self._name] = value
+        if self._index_name is None:
+            instance._arrays[self._name] = list(value)
+        else:
+            instance._arrays[self._name] = np.asarray(value, dtype='float64')
+        if self._name in ['_target_min', '_target_max']:
+            instance._target_bounds_cache = None
+        if self._name in ['_feature_min', '_feature_max']:
+            instance._feature_bounds_cache = None
+
+class QuaLiKizNN():
+    """ Base class for all QuaLiKiz neural networks
+
+    Keeps the target bounds used for clipping as plain arrays, so they do
+    not have to be extracted from the pandas Series on every call. The
+    cache is rebuilt when _target_min or _target_max is re-assigned.
+    Unknown (NaN) bounds, e.g. a combo_func evaluated outside its domain,
+    do not clip.
+    """
+    @property
+    def _feature_name_list(self):
+        return list(self._feature_names)
+
+    @property
+    def _target_name_list(self):
+        return list(self._target_names)
+
+    @property
+    def _target_min(self):
+        return self._target_min_series
+
+    @_target_min.setter
+    def _target_min(self, value):
+        self._target_min_series = value
+        self._target_bounds_cache = None
+
+    @property
+    def _target_max(self):
+        return self._target_max_series
+
+    @_target_max.setter
+    def _target_max(self, value):
+        self._target_max_series = value
+        self._target_bounds_cache = None
+
+    def _update_target_bounds(self):
+        self._target_bounds_cache = (_fill_unknown(self._target_min.values, -np.inf),
+                                     _fill_unknown(self._target_max.values, np.inf))
+
+    @property
+    def _target_bounds(self):
+        """ Tuple of (target_min, target_max) float64 arrays """
+        if self._target_bounds_cache is None:
+            self._update_target_bounds()
+        return self._target_bounds_cache
+
+    @property
+    def _feature_bounds(self):
+        """ Tuple of (feature_min, feature_max) float64 arrays
+
+        In the order of _feature_names. For combined networks this is the
+        intersection of the domains of all underlying networks; unknown
+        (NaN) bounds of a network do not restrict it. Computed once.
+        """
+        bounds = self.__dict__.get('_feature_bounds_cache')
+        if bounds is None:
+            bounds = self._feature_bounds_cache = self._compute_feature_bounds()
+        return bounds
+
+    def _compute_feature_bounds(self):
+        feature_names = self._feature_name_list
+        low = np.full(len(feature_names), -np.inf)
+        high = np.full(len(feature_names), np.inf)
+        for nn in _leaf_networks(self):
+            leaf_low, leaf_high = nn._feature_bounds
+            leaf_names = nn._feature_name_list
+            for ii, name in enumerate(feature_names):
+                if name in leaf_names:
+                    low[ii] = np.fmax(low[ii], leaf_low[leaf_names.index(name)])
+                    high[ii] = np.fmin(high[ii], leaf_high[leaf_names.index(name)])
+        return low, high
+
+    # Checks the input against the training domain, see enable_domain_guard
+    _domain_guard = None
+
+    def enable_domain_guard(self, policy='flag'):
+        """ Check all input against the training domain
+
+        The input of get_output, predict_array, predict_chunked and
+        predict_jacobian is checked against _feature_bounds with the given
+        policy ('flag', 'clamp' or 'raise'), see domain_guard. The bounds are
+        taken when the guard is enabled.
+        """
+        low, high = self._feature_bounds
+        self._domain_guard = DomainGuard(self._feature_name_list, low, high, policy=policy)
+        return self._domain_guard
+
+    def disable_domain_guard(self):
+        self._domain_guard = None
+
+    def domain_stats(self):
+        """ Counters of input outside the training domain, see DomainGuard.stats """
+        if self._domain_guard is None:
+            raise Exception('Domain guard not enabled, call enable_domain_guard first')
+        return self._domain_guard.stats()
+
+    def _check_domain(self, input):
+        if self._domain_guard is None:
+            return input
+        return self._domain_guard.apply(input)
+
+    # Column order of arrays passed to predict_array, None if it is
+    # the order of _feature_names
+    _input_permutation = None
+
+    def bind_feature_order(self, feature_names):
+        """ Set the column order of the arrays passed to predict_array
+
+        feature_names may contain more names than this network uses; the
+        extra columns are ignored. The order is checked only once, here.
+        """
+        self._input_permutation = _feature_permutation(feature_names, self._feature_name_list)
+
+    def _order_input(self, input):
+        """ Put the columns of input in the order of _feature_names, and check the domain """
+        input = np.asarray(input, dtype='float64')
+        if self._input_permutation is not None:
+            input = input[:, self._input_permutation]
+        return self._check_domain(input)
+
+    def _init_leaves(self):
+        """ Find the distinct QuaLiKizNDNNs this (combined) network is built from """
+        self._leaves, self._leaf_aliases = _unique_leaves(_leaf_networks(self))
+        self._leaf_permutations = _feature_permutations(self._feature_name_list, self._leaves)
+
+    def _check_features(self):
+        """ Raise if some networks use features that are not in _feature_names
+
+        Such networks can only be evaluated by get_output in safe mode,
+        which selects the features of every network by name.
+        """
+        if self._leaf_permutations is None:
+            raise Exception('Networks use features that are not in {!s}, use get_output with safe=True'
+                            .format(self._feature_name_list))
+
+    def _leaf_outputs(self, input):
+        """ Unclipped output of all underlying QuaLiKizNDNNs, evaluating each once
+
+        Returns a dict mapping id(network) to its output, as StackedPlan.apply.
+        """
+        input = np.asarray(input)
+        return self._evaluate_leaves(lambda nn, permutation: nn._predict(_permute(input, permutation)))
+
+    def _evaluate_leaves(self, evaluate):
+        """ Dict of id(network) -> evaluate(network, permutation) for all underlying QuaLiKizNDNNs
+
+        permutation selects the features of the network from those of self.
+        """
+        self._check_features()
+        outputs = {}
+        for nn, permutation in zip(self._leaves, self._leaf_permutations):
+            outputs[id(nn)] = evaluate(nn, permutation)
+        for alias, nn_id in self._leaf_aliases.items():
+            outputs[alias] = outputs[nn_id]
+        return outputs
+
+    def sweep(self, base, feature, values, clip_low=True, clip_high=True):
+        """ Output along a line through base in the direction of one feature
+
+        base is a point in feature space, as dict of feature name -> value
+        or as 1D array in the order of _feature_names. Returns the output for
+        base with feature set to each of values, as array of shape
+        (len(values), n_targets) clipped as by predict_array. The input
+        matrix is never built: the first layer preactivation is that of base
+        plus a rank-one update in values.
+
+        Many sweeps along the same feature are evaluated in one batch by
+        passing a 2D array of base points of shape (n_sweeps, n_features);
+        the output then has shape (n_sweeps, len(values), n_targets).
+        """
+        bases = self._base_points(base)
+        values = np.ravel(np.asarray(values, dtype='float64'))
+        output = self._sweep(bases, self._feature_name_list.index(feature), values)
+        low_bound, high_bound = self._target_bounds
+        output = clip_to_bounds(output, clip_low, clip_high, low_bound, high_bound)
+        if isinstance(base, dict) or np.ndim(base) == 1:
+            return output
+        return np.reshape(output, (bases.shape[0], len(values), -1))
+
+    def _base_points(self, base):
+        """ Base points of sweep as 2D array """
+        feature_names = self._feature_name_list
+        if isinstance(base, dict):
+            missing = [name for name in feature_names if name not in base]
+            if len(missing) > 0:
+                raise Exception('Base point is missing features {!s}'.format(missing))
+            base = [base[name] for name in feature_names]
+        base = np.atleast_2d(np.asarray(base, dtype='float64'))
+        if base.ndim != 2 or base.shape[1] != len(feature_names):
+            raise Exception('Base points should have {:d} features'.format(len(feature_names)))
+        return base
+
+    def _sweep(self, bases, index, values):
+        """ Unclipped output of sweep as (n_sweeps * n_values, n_targets) array
+
+        bases are full points and index is the swept feature.
+        """
+        name = self._feature_name_list[index]
+        def evaluate(nn, permutation):
+            return nn._sweep(_permute(bases, permutation), nn._feature_name_list.index(name), values)
+        return self._combine(self._evaluate_leaves(evaluate))
+
+    def find_thresholds(self, base, feature, low=None, high=None, level=0., xtol=1e-6,
+                        n_bracket=16, max_iter=50):
+        """ Values of feature where the output crosses level, for many base points at once
+
+        base is one or more points in feature space, as for sweep. For every
+        base point and target, returns the last value of feature in
+        [low, high] where the unclipped output crosses level (a scalar or one
+        level per target), or NaN if it does not cross it. With the default
+        level this is where the clipped flux leaves zero. low and high
+        default to the bounds of feature in the training set.
+
+        The crossings are bracketed on a grid of n_bracket points, evaluated
+        with sweep, and refined to xtol with Newton steps on the analytic
+        derivative, falling back to bisection when a step leaves the
+        bracket. As when scanning a grid, crossings closer together than
+        the grid spacing can be missed.
+
+        Returns an array of shape (n_targets, ), or (n_points, n_targets)
+        if base is 2D.
+        """
+        bases = self._base_points(base)
+        index = self._feature_name_list.index(feature)
+        low, high = self._feature_interval(index, low, high)
+        n_targets = len(self._target_name_list)
+        level = np.broadcast_to(np.asarray(level, dtype='float64'), (n_targets, ))
+        grid = np.linspace(low, high, n_bracket)
+        scan = np.reshape(self._sweep(bases, index, grid), (len(bases), n_bracket, n_targets)) - level
+        # Last interval of the grid in which the output crosses level
+        above = scan > 0
+        crossing = above[:, 1:] != above[:, :-1]
+        last = n_bracket - 2 - np.argmax(crossing[:, ::-1], axis=1)
+        found = np.any(crossing, axis=1)
+        point, target = np.nonzero(found)
+        interval = last[point, target]
+
+        def evaluate(x, active):
+            rows = bases[point[active]]
+            rows[:, index] = x
+            output, jacobian = self._predict_jacobian(rows, [feature])
+            return (output[np.arange(len(x)), target[active]] - level[target[active]],
+                    jacobian[np.arange(len(x)), target[active], 0])
+
+        thresholds = np.full((len(bases), n_targets), np.nan)
+        thresholds[point, target] = _bracketed_newton(
+            evaluate, grid[interval], grid[interval + 1],
+            scan[point, interval, target], scan[point, interval + 1, target],
+            xtol=xtol, max_iter=max_iter)
+        if isinstance(base, dict) or np.ndim(base) == 1:
+            return thresholds[0]
+        return thresholds
+
+    def solve_feature(self, input, feature, target_values, target=None, low=None, high=None,
+                      xtol=1e-6, n_bracket=16, max_bracket=1024, max_iter=50):
+        """ Solve for the value of feature that gives target_values, row by row
+
+        The inverse of predict_array: for every row of input (ordered as for
+        predict_array) finds the value of feature for which the unclipped
+        output of target equals target_values (a scalar or one value per
+        row), with the other features fixed. target can be omitted for
+        single-target networks. The solution is searched in [low, high],
+        by default the bounds of feature in the training set.
+
+        The solutions are bracketed on a grid of n_bracket points, evaluated
+        with sweep, and refined to xtol with Newton steps on the analytic
+        derivative, safeguarded by bisection. If there are several, the one
+        closest to the value of feature in input is taken, so passing the
+        previous solution gives a continuous solution; for NaN the smallest.
+        Rows without a bracket where the output comes closer to
+        target_values than it changes between grid points are scanned again
+        on grids eight times as fine, up to max_bracket points.
+
+        Returns an array of shape (n_rows, ) with NaN for the rows where no
+        bracket was found. As when scanning a grid, this includes rows with
+        only solutions closer together than the spacing of the finest grid,
+        or where the output touches target_values without crossing it.
+        """
+        input = self._order_input(input)
+        index = self._feature_name_list.index(feature)
+        low, high = self._feature_interval(index, low, high)
+        if target is None:
+            if len(self._target_name_list) != 1:
+                raise Exception('Network has multiple targets, choose one of {!s}'.format(
+                    self._target_name_list))
+            target = self._target_name_list[0]
+        column = self._target_name_list.index(target)
+        n_rows = input.shape[0]
+        target_values = np.broadcast_to(np.asarray(target_values, dtype='float64'), (n_rows, ))
+
+        start = input[:, index]
+
+        def scan(rows, n_points):
+            """ Output on a grid, and the intervals with a crossing closest to the start """
+            grid = np.linspace(low, high, n_points)
+            output = np.reshape(self._sweep(input[rows], index, grid),
+                                (len(rows), n_points, len(self._target_name_list)))
+            output = output[:, :, column] - target_values[rows, np.newaxis]
+            above = output > 0
+            crossing = above[:, 1:] != above[:, :-1]
+            distance = np.abs(0.5 * (grid[1:] + grid[:-1]) - start[rows, np.newaxis])
+            interval = np.argmin(np.where(crossing, distance, np.inf), axis=1)
+            return grid, output, np.any(crossing, axis=1), interval
+
+        grid, scan_output, solvable, interval = scan(np.arange(n_rows), n_bracket)
+        rows = np.arange(n_rows)
+        above = scan_output > 0
+        bracket_low, bracket_high = grid[interval], grid[interval + 1]
+        f_low, f_high = scan_output[rows, interval], scan_output[rows, interval + 1]
+
+        # Split the interval of the start at the start, so that a solution
+        # close to it is found even if the interval has several
+        inside = np.flatnonzero((start > low) & (start < high))
+        own = np.searchsorted(grid, start[inside]) - 1
+        output, jacobian = self._predict_jacobian(input[inside], [feature])
+        f_start = output[:, column] - target_values[inside]
+        # Starts that already are a solution, e.g. the previous one
+        at_start = inside[np.abs(f_start) <= 0.5 * xtol * np.abs(jacobian[:, column, 0])]
+        left = (f_start > 0) != above[inside, own]
+        right = ~left & ((f_start > 0) != above[inside, own + 1])
+        bracket_low[inside[left]] = grid[own[left]]
+        f_low[inside[left]] = scan_output[inside[left], own[left]]
+        bracket_high[inside[left]] = start[inside[left]]
+        f_high[inside[left]] = f_start[left]
+        bracket_low[inside[right]] = start[inside[right]]
+        f_low[inside[right]] = f_start[right]
+        bracket_high[inside[right]] = grid[own[right] + 1]
+        f_high[inside[right]] = scan_output[inside[right], own[right] + 1]
+        solvable[inside[left | right]] = True
+        solvable[at_start] = False
+
+        # Look for brackets on finer grids where none was found, but a
+        # crossing between the grid points is possible
+        unsolved = np.flatnonzero(~solvable)
+        unsolved_output = scan_output[unsolved]
+        n_points = n_bracket
+        while len(unsolved) > 0 and 8 * (n_points - 1) + 1 <= max_bracket:
+            near = (np.min(np.abs(unsolved_output), axis=1) <=
+                    np.max(np.abs(np.diff(unsolved_output, axis=1)), axis=1))
+            near &= ~np.isin(unsolved, at_start)
+            unsolved = unsolved[near]
+            if len(unsolved) == 0:
+                break
+            n_points = 8 * (n_points - 1) + 1
+            grid, scan_output, found, interval = scan(unsolved, n_points)
+            rows, interval = unsolved[found], interval[found]
+            bracket_low[rows], bracket_high[rows] = grid[interval], grid[interval + 1]
+            f_low[rows] = scan_output[found, interval]
+            f_high[rows] = scan_output[found, interval + 1]
+            solvable[rows] = True
+            unsolved, unsolved_output = unsolved[~found], scan_output[~found]
+        solvable = np.flatnonzero(solvable)
+
+        def evaluate(x, active):
+            rows = input[solvable[active]]
+            rows[:, index] = x
+            output, jacobian = self._predict_jacobian(rows, [feature])
+            return output[:, column] - target_values[solvable[active]], jacobian[:, column, 0]
+
+        solution = np.full(n_rows, np.nan)
+        solution[at_start] = start[at_start]
+        solution[solvable] = _bracketed_newton(
+            evaluate, bracket_low[solvable], bracket_high[solvable],
+            f_low[solvable], f_high[solvable], xtol=xtol, max_iter=max_iter)
+        return solution
+
+    def _feature_interval(self, index, low, high):
+        """ low and high, defaulting to the training bounds of feature index """
+        feature_low, feature_high = self._feature_bounds
+        low = feature_low[index] if low is None else float(low)
+        high = feature_high[index] if high is None else float(high)
+        if not (np.isfinite(low) and np.isfinite(high)):
+            raise Exception('No bounds known for feature {!s}, pass low and high'.format(
+                self._feature_name_list[index]))
+        if low >= high:
+            raise Exception('low should be smaller than high')
+        return low, high
+
+    def predict_array(self, input, out=None, clip_low=True, clip_high=True):
+        """ Calculate the output for a 2D array of inputs, without pandas
+
+        The columns of input should be in the order of _feature_names, or
+        in the order set by bind_feature_order. The result is written into
+        out (of shape (n_rows, n_targets)) if it is given. The output is
+        clipped to _target_min and _target_max.
+        """
+        input = self._order_input(input)
+        output = self._predict(input, out=out)
+        low_bound, high_bound = self._target_bounds
+        return clip_to_bounds(output, clip_low, clip_high, low_bound, high_bound)
+
+    def predict_chunked(self, input, out=None, clip_low=True, clip_high=True,
+                        chunk_size=CHUNK_SIZE, workers=None):
+        """ predict_array for very large inputs, in row tiles on a thread pool
+
+        The rows are split in tiles of chunk_size rows, which are evaluated
+        by `workers` threads (default: one per core) and written into a single
+        preallocated output. Peak memory is limited to a few tiles of
+        intermediate results per thread. NumPy releases the GIL in BLAS and
+        in ufuncs, so the threads run in parallel. Consider limiting the
+        number of threads of the BLAS library itself when using many workers.
+        """
+        input = np.asarray(input)
+        n_rows = input.shape[0]
+        if out is None:
+            out = np.empty((n_rows, len(self._target_name_list)))
+        if workers is None:
+            workers = os.cpu_count()
+
+        def predict_tile(start):
+            stop = min(start + chunk_size, n_rows)
+            self.predict_array(input[start:stop], out=out[start:stop],
+                               clip_low=clip_low, clip_high=clip_high)
+
+        starts = range(0, n_rows, chunk_size)
+        if workers == 1 or len(starts) <= 1:
+            for start in starts:
+                predict_tile(start)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Iterate over the results to re-raise exceptions
+                for _ in pool.map(predict_tile, starts):
+                    pass
+        return out
+
+    def predict_jacobian(self, input, features=None, clip_low=True, clip_high=True):
+        """ Output and its analytic derivatives to (a subset of) the features
+
+        The input columns are ordered as for predict_array. The derivatives
+        are calculated in forward mode in the same batched pass as the
+        output. Returns a tuple (output, jacobian) with output of shape
+        (n_rows, n_targets) and jacobian of shape (n_rows, n_targets,
+        n_selected), where jacobian[:, :, ii] is the derivative to
+        features[ii]. Where the output is clipped its derivative is zero.
+        """
+        input = self._order_input(input)
+        if features is None:
+            features = self._feature_name_list
+        output, jacobian = self._predict_jacobian(input, list(features))
+        low_bound, high_bound = self._target_bounds
+        return _clip_jacobian(output, jacobian, clip_low, clip_high, low_bound, high_bound)
+
+class QuaLiKizMultiNN(QuaLiKizNN):
     def __init__(self, nns):
+        pd = _pandas()
         self._nns = nns
         feature_names = nns[0]
         for nn in self._nns:
@@ -33,65 +537,119 @@ class QuaLiKizMultiNN():
             [nn._target_min for nn in self._nns])
         self._target_max = pd.concat(
             [nn._target_max for nn in self._nns])
-
-    @property
-    def _target_names(self):
-        targets = []
+        self._update_target_bounds()
+        self._plan = None
+        # Names and output columns of all networks, so evaluation does not
+        # have to go through their pandas target names
+        self._target_names = []
+        self._child_columns = []
         for nn in self._nns:
-            targets.extend(list(nn._target_names))
-        return targets
+            start = len(self._target_names)
+            self._target_names.extend(nn._target_name_list)
+            self._child_columns.append(slice(start, len(self._target_names)))
+        self._child_permutations = _feature_permutations(self._feature_name_list, self._nns)
+        self._init_leaves()
 
     def get_output(self, input, output_pandas=True, clip_low=True, clip_high=True, low_bound=None, high_bound=None, **kwargs):
-        results = pd.DataFrame()
-        feature_max = -np.inf
-        feature_min = np.inf
-        out_tot = np.empty((input.shape[0], len(self._nns)))
-        out_name = []
+        """ Calculate the output of all networks
+
+        All outputs are written into a single array, which is converted
+        to a DataFrame only at the end if output_pandas is True.
+        """
+        timer = nn_profiling.StageTimer('QuaLiKizMultiNN', len(input)) if nn_profiling.ENABLED else None
         nn_input, kwargs['safe'], clip_low, clip_high, low_bound, high_bound = \
             determine_settings(self, input, kwargs['safe'], clip_low, clip_high, low_bound, high_bound)
-        for ii, nn in enumerate(self._nns):
-            if len(nn._target_names) == 1:
-                out = nn.get_output(input, clip_low=False, clip_high=False, **kwargs)
-                out_tot[:, ii] = np.squeeze(out)
-                if output_pandas:
-                    out_name.extend(out.columns.values)
-            elif target in nn.target_names.values:
-                NotImplementedError('Multitarget not implemented yet')
+        nn_input = self._check_domain(nn_input)
+        if timer is not None:
+            timer.lap('determine_settings')
+        output = np.empty((len(nn_input), len(self._target_names)))
+        if kwargs['safe'] and self._leaf_permutations is None:
+            # Some networks use features that nns[0] lacks
+            for nn, columns in zip(self._nns, self._child_columns):
+                output[:, columns] = nn.get_output(_checked_frame(self, input, nn_input), output_pandas=False,
+                                                   clip_low=False, clip_high=False, safe=True)
+            if timer is not None:
+                timer.lap('children')
+        elif self._plan is not None:
+            self._combine(self._plan.apply(nn_input), out=output)
+            if timer is not None:
+                timer.lap('plan')
+        else:
+            # Networks shared by several children are evaluated only once
+            leaf_outputs = self._leaf_outputs(nn_input)
+            if timer is not None:
+                timer.lap('children')
+            self._combine(leaf_outputs, out=output)
+            if timer is not None:
+                timer.lap('combo_func')
+        output = clip_to_bounds(output, clip_low=clip_low, clip_high=clip_high, low_bound=low_bound, high_bound=high_bound)
+        if timer is not None:
+            timer.lap('clip_to_bounds')
+        if output_pandas is True:
+            output = _pandas().DataFrame(output, columns=self._target_names)
+        if timer is not None:
+            timer.lap('to_pandas')
+            timer.done()
+        return output
 
+    def compile_plan(self, max_workspaces=8):
+        """ Evaluate all underlying QuaLiKizNDNNs with a single StackedPlan """
+        self._plan = StackedPlan(_leaf_networks(self), self._feature_names,
+                                 max_workspaces=max_workspaces)
+        return self._plan
 
-        out_tot = clip_to_bounds(out_tot, clip_low=clip_low, clip_high=clip_high, low_bound=low_bound, high_bound=high_bound)
-        if output_pandas == True:
-            results = pd.DataFrame(out_tot, columns=out_name)
-        else:
-            results = out_tot
-        return results
+    def clear_plan(self):
+        self._plan = None
 
-    @property
-    def _target_names(self):
-        return flatten([list(nn._target_names) for nn in self._nns])
+    def specialise(self, fixed, **kwargs):
+        """ Specialise all networks, see QuaLiKizNDNN.specialise """
+        return QuaLiKizMultiNN([nn.specialise(fixed, **kwargs) for nn in self._nns])
+
+    def _combine(self, leaf_outputs, out=None):
+        if out is None:
+            n_rows = next(iter(leaf_outputs.values())).shape[0]
+            out = np.empty((n_rows, len(self._target_names)))
+        for nn, columns in zip(self._nns, self._child_columns):
+            nn._combine(leaf_outputs, out=out[:, columns])
+        return out
+
+    def _predict_jacobian(self, input, features):
+        self._check_features()
+        results = [nn._predict_jacobian(_permute(input, permutation), features)
+                   for nn, permutation in zip(self._nns, self._child_permutations)]
+        output = np.concatenate([np.reshape(output, (input.shape[0], -1)) for output, _ in results], axis=1)
+        jacobian = np.concatenate([np.reshape(jacobian, (input.shape[0], -1, len(features)))
+                                   for _, jacobian in results], axis=1)
+        return output, jacobian
+
+    def _predict(self, input, out=None):
+        if out is None:
+            out = np.empty((input.shape[0], len(self._target_names)))
+        if self._plan is not None:
+            self._combine(self._plan.apply(input), out=out)
+        else:
+            self._combine(self._leaf_outputs(input), out=out)
+        return out
 
     @property
     def _feature_names(self):
         return self._nns[0]._feature_names
 
+    @property
+    def _feature_name_list(self):
+        return self._nns[0]._feature_name_list
+
     @property
     def _feature_max(self):
-        feature_max = pd.Series(np.full_like(self._nns[0]._feature_max, np.inf),
-                                index=self._nns[0]._feature_max.index)
-        for nn in self._nns:
-            feature_max = nn._feature_max.combine(feature_max, min)
-        return feature_max
+        return _pandas().Series(self._feature_bounds[1], index=self._feature_name_list)
 
     @property
     def _feature_min(self):
-        feature_min = pd.Series(np.full_like(self._nns[0]._feature_min, -np.inf),
-                                index=self._nns[0]._feature_min.index)
-        for nn in self._nns:
-            feature_min = nn._feature_min.combine(feature_min, max)
-        return feature_min
+        return _pandas().Series(self._feature_bounds[0], index=self._feature_name_list)
 
-class QuaLiKizComboNN():
+class QuaLiKizComboNN(QuaLiKizNN):
     def __init__(self, target_names, nns, combo_func):
+        pd = _pandas()
         self._nns = nns
         feature_names = nns[0]
         for nn in self._nns:
@@ -100,6 +658,8 @@ class QuaLiKizComboNN():
         if np.any(self._feature_min > self._feature_max):
             raise Exception('Feature min > feature max')
 
+        if isinstance(combo_func, str):
+            combo_func = Recipe(combo_func)
         self._combo_func = combo_func
         self._target_names = target_names
         self._target_min = pd.Series(
@@ -108,37 +668,114 @@ class QuaLiKizComboNN():
         self._target_max = pd.Series(
             self._combo_func(*[nn._target_max.values for nn in nns]),
             index=self._target_names)
+        self._update_target_bounds()
+        self._plan = None
+        self._child_permutations = _feature_permutations(self._feature_name_list, self._nns)
+        self._init_leaves()
 
     def get_output(self, input, output_pandas=True, clip_low=True, clip_high=True, low_bound=None, high_bound=None, **kwargs):
+        timer = nn_profiling.StageTimer('QuaLiKizComboNN', len(input)) if nn_profiling.ENABLED else None
         nn_input, kwargs['safe'], clip_low, clip_high, low_bound, high_bound = \
             determine_settings(self, input, kwargs['safe'], clip_low, clip_high, low_bound, high_bound)
-        output = self._combo_func(*[nn.get_output(input, output_pandas=False, clip_low=False, clip_high=False, **kwargs) for nn in self._nns])
+        nn_input = self._check_domain(nn_input)
+        if timer is not None:
+            timer.lap('determine_settings')
+        output = np.empty((len(nn_input), len(self._target_names)))
+        if kwargs['safe'] and self._leaf_permutations is None:
+            # Some networks use features that nns[0] lacks
+            frame = _checked_frame(self, input, nn_input)
+            outputs = [nn.get_output(frame, output_pandas=False, clip_low=False, clip_high=False, safe=True)
+                       for nn in self._nns]
+            output[...] = np.reshape(self._combo_func(*outputs), output.shape)
+            if timer is not None:
+                timer.lap('combo_func')
+        elif self._plan is not None:
+            self._combine(self._plan.apply(nn_input), out=output)
+            if timer is not None:
+                timer.lap('plan')
+        else:
+            leaf_outputs = self._leaf_outputs(nn_input)
+            if timer is not None:
+                timer.lap('children')
+            self._combine(leaf_outputs, out=output)
+            if timer is not None:
+                timer.lap('combo_func')
         output = clip_to_bounds(output, clip_low=clip_low, clip_high=clip_high, low_bound=low_bound, high_bound=high_bound)
+        if timer is not None:
+            timer.lap('clip_to_bounds')
         if output_pandas is True:
-            output = pd.DataFrame(output, columns=self._target_names)
+            output = _pandas().DataFrame(output, columns=self._target_names)
+        if timer is not None:
+            timer.lap('to_pandas')
+            timer.done()
         return output
 
+    def compile_plan(self, max_workspaces=8):
+        """ Evaluate all underlying QuaLiKizNDNNs with a single StackedPlan """
+        self._plan = StackedPlan(_leaf_networks(self), self._feature_names,
+                                 max_workspaces=max_workspaces)
+        return self._plan
+
+    def clear_plan(self):
+        self._plan = None
+
+    def specialise(self, fixed, **kwargs):
+        """ Specialise all networks, see QuaLiKizNDNN.specialise """
+        return QuaLiKizComboNN(self._target_names, [nn.specialise(fixed, **kwargs) for nn in self._nns],
+                               self._combo_func)
+
+    def _combine(self, leaf_outputs, out=None):
+        outputs = [nn._combine(leaf_outputs) for nn in self._nns]
+        if isinstance(self._combo_func, Recipe):
+            return self._combo_func.evaluate(outputs, out=out)
+        output = self._combo_func(*outputs)
+        if out is None:
+            return output
+        out[...] = np.reshape(output, out.shape)
+        return out
+
+    def _predict_jacobian(self, input, features):
+        self._check_features()
+        # Propagate the derivatives through combo_func with dual numbers
+        duals = [_Dual(*nn._predict_jacobian(_permute(input, permutation), features))
+                 for nn, permutation in zip(self._nns, self._child_permutations)]
+        result = self._combo_func(*duals)
+        return result.value, result.grad
+
+    def _predict(self, input, out=None):
+        if out is None:
+            out = np.empty((input.shape[0], len(self._target_names)))
+        if self._plan is not None:
+            self._combine(self._plan.apply(input), out=out)
+        else:
+            self._combine(self._leaf_outputs(input), out=out)
+        return out
+
     @property
     def _feature_names(self):
         return self._nns[0]._feature_names
 
+    @property
+    def _feature_name_list(self):
+        return self._nns[0]._feature_name_list
+
     @property
     def _feature_max(self):
-        feature_max = pd.Series(np.full_like(self._nns[0]._feature_max, np.inf),
-                                index=self._nns[0]._feature_max.index)
-        for nn in self._nns:
-            feature_max = nn._feature_max.combine(feature_max, min)
-        return feature_max
+        return _pandas().Series(self._feature_bounds[1], index=self._feature_name_list)
 
     @property
     def _feature_min(self):
-        feature_min = pd.Series(np.full_like(self._nns[0]._feature_min, -np.inf),
-                                index=self._nns[0]._feature_min.index)
-        for nn in self._nns:
-            feature_min = nn._feature_min.combine(feature_min, max)
-        return feature_min
+        return _pandas().Series(self._feature_bounds[0], index=self._feature_name_list)
+
+class QuaLiKizDuoNN(QuaLiKizNN):
+    """ Targets calculated with combo_funcs from the outputs of two networks
 
-class QuaLiKizDuoNN():
+    Every combo_func is called with the output arrays of nn1 and nn2. A
+    combo_func that fails on arrays, e.g. one that selects columns by name
+    as lambda a, b: a['efe_GB'] + b['efi_GB'], is called with DataFrames
+    of the outputs instead, labelled with their target names. That is
+    much slower, prefer functions of arrays or recipe strings.
+    """
     def __init__(self, target_names, nn1, nn2, combo_funcs):
         self._nn1 = nn1
         self._nn2 = nn2
@@ -149,38 +786,202 @@ class QuaLiKizDuoNN():
         if not len(target_names) == len(combo_funcs):
             raise Exception('len(target_names) = {.f} and len(combo_func) = {.f}'
                             .format(len(target_names),  len(combo_funcs)))
-        self._combo_funcs = combo_funcs
+        self._combo_funcs = [Recipe(combo_func) if isinstance(combo_func, str) else combo_func
+                             for combo_func in combo_funcs]
+        # Whether every combo_func needs labelled DataFrames
+        self._labelled_funcs = [False] * len(self._combo_funcs)
+        self._output_labels = [_output_labels(nn) for nn in [nn1, nn2]]
         self._target_names = target_names
+        self._child_permutations = [_feature_permutation(self._feature_names, nn._feature_names)
+                                    for nn in [nn1, nn2]]
 
-    def get_output(self, input, **kwargs):
-        output = pd.DataFrame()
-        output1 = self._nn1.get_output(input, **kwargs)
-        output2 = self._nn2.get_output(input, **kwargs)
-        for target_name, combo_func in zip(self._target_names, self._combo_funcs):
-            output[target_name] = np.squeeze(combo_func(output1, output2))
+    def get_output(self, input, output_pandas=True, clip_low=True, clip_high=True,
+                   low_bound=None, high_bound=None, safe=True):
+        """ Calculate the combined output of both networks
+
+        The outputs of both networks are clipped to their own bounds, or to
+        low_bound and high_bound (selected by target name in safe mode),
+        before they are combined. The combo_funcs are called with the
+        output arrays of both networks, and the results are written into a
+        single array that is converted to a DataFrame if output_pandas is True.
+        """
+        nn_input = determine_settings(self, input, safe, False, False, None, None)[0]
+        nn_input = self._check_domain(np.asarray(nn_input, dtype='float64'))
+        bounds = []
+        for nn in [self._nn1, self._nn2]:
+            nn_low, nn_high = nn._target_bounds
+            if low_bound is not None:
+                nn_low = _fill_unknown(low_bound[nn._target_names].values if safe else low_bound, -np.inf)
+            if high_bound is not None:
+                nn_high = _fill_unknown(high_bound[nn._target_names].values if safe else high_bound, np.inf)
+            bounds.append((nn_low, nn_high))
+        output = self._predict_clipped(nn_input, None, clip_low, clip_high, bounds=bounds)
+        if output_pandas is True:
+            output = _pandas().DataFrame(output, columns=self._target_names)
         return output
 
+    def predict_array(self, input, out=None, clip_low=True, clip_high=True):
+        """ Calculate the output for a 2D array of inputs, without pandas
+
+        As get_output, the outputs of both networks are clipped before
+        they are combined.
+        """
+        return self._predict_clipped(self._order_input(input), out, clip_low, clip_high)
+
+    def _predict_clipped(self, input, out, clip_low, clip_high, bounds=None):
+        """ Combined output with the outputs of both networks clipped to bounds
+
+        bounds is a (low_bound, high_bound) pair per network, by default
+        their _target_bounds.
+        """
+        if bounds is None:
+            bounds = [self._nn1._target_bounds, self._nn2._target_bounds]
+        outputs = []
+        for nn, permutation, (low_bound, high_bound) in zip([self._nn1, self._nn2], self._child_permutations,
+                                                              bounds):
+            outputs.append(clip_to_bounds(nn._predict(_permute(input, permutation)),
+                                          clip_low, clip_high, low_bound, high_bound))
+        if out is None:
+            out = np.empty((input.shape[0], len(self._target_names)))
+        self._apply_combo_funcs(outputs, out)
+        return out
+
+    def predict_jacobian(self, input, features=None, clip_low=True, clip_high=True):
+        """ Output and its analytic derivatives, see QuaLiKizNN.predict_jacobian
+
+        As predict_array, the outputs of both networks are clipped before
+        they are combined.
+        """
+        input = self._order_input(input)
+        if features is None:
+            features = list(self._feature_names)
+        return self._predict_jacobian(input, list(features), clip_low=clip_low, clip_high=clip_high)
+
+    def _predict_jacobian(self, input, features, clip_low=True, clip_high=True):
+        duals = []
+        for nn, permutation, labels in zip([self._nn1, self._nn2], self._child_permutations, self._output_labels):
+            low_bound, high_bound = nn._target_bounds
+            output, jacobian = nn._predict_jacobian(_permute(input, permutation), list(features))
+            duals.append(_Dual(*_clip_jacobian(output, jacobian, clip_low, clip_high, low_bound, high_bound),
+                               columns=labels))
+        results = [combo_func(*duals) for combo_func in self._combo_funcs]
+        output = np.stack([np.reshape(result.value, (input.shape[0], )) for result in results], axis=1)
+        jacobian = np.stack([np.reshape(result.grad, (input.shape[0], len(features))) for result in results], axis=1)
+        return output, jacobian
+
+    def sweep(self, base, feature, values, clip_low=True, clip_high=True):
+        """ Output along a line through base, see QuaLiKizNN.sweep
+
+        As predict_array, the outputs of both networks are clipped before
+        they are combined.
+        """
+        bases = self._base_points(base)
+        values = np.ravel(np.asarray(values, dtype='float64'))
+        out = self._sweep(bases, self._feature_name_list.index(feature), values,
+                          clip_low=clip_low, clip_high=clip_high)
+        if isinstance(base, dict) or np.ndim(base) == 1:
+            return out
+        return np.reshape(out, (bases.shape[0], len(values), -1))
+
+    def _sweep(self, bases, index, values, clip_low=True, clip_high=True):
+        name = self._feature_name_list[index]
+        outputs = []
+        for nn, permutation in zip([self._nn1, self._nn2], self._child_permutations):
+            low_bound, high_bound = nn._target_bounds
+            output = nn._sweep(_permute(bases, permutation), nn._feature_name_list.index(name), values)
+            outputs.append(clip_to_bounds(output, clip_low, clip_high, low_bound, high_bound))
+        out = np.empty((outputs[0].shape[0], len(self._target_names)))
+        self._apply_combo_funcs(outputs, out)
+        return out
+
+    def _apply_combo_funcs(self, outputs, out):
+        """ Write the result of every combo_func(*outputs) into a column of out """
+        for ii, combo_func in enumerate(self._combo_funcs):
+            if isinstance(combo_func, Recipe):
+                combo_func.evaluate(outputs, out=out[:, ii:ii + 1])
+                continue
+            if not self._labelled_funcs[ii]:
+                try:
+                    result = combo_func(*outputs)
+                except Exception:
+                    self._labelled_funcs[ii] = True
+            if self._labelled_funcs[ii]:
+                frames = [_pandas().DataFrame(output, columns=labels)
+                          for output, labels in zip(outputs, self._output_labels)]
+                result = combo_func(*frames)
+            out[:, ii] = np.reshape(np.asarray(result), (out.shape[0], ))
+
+    def specialise(self, fixed, **kwargs):
+        """ Specialise both networks, see QuaLiKizNDNN.specialise """
+        return QuaLiKizDuoNN(self._target_names, self._nn1.specialise(fixed, **kwargs),
+                             self._nn2.specialise(fixed, **kwargs), self._combo_funcs)
+
+    def _combine(self, leaf_outputs, out=None):
+        # As part of a larger network the outputs are combined unclipped
+        outputs = [nn._combine(leaf_outputs) for nn in [self._nn1, self._nn2]]
+        if out is None:
+            out = np.empty((outputs[0].shape[0], len(self._target_names)))
+        self._apply_combo_funcs(outputs, out)
+        return out
+
     @property
     def _feature_names(self):
         return self._nn1._feature_names
 
     @property
     def _feature_max(self):
-        return self._nn1._feature_max.combine(self._nn2._feature_max, min)
+        return _pandas().Series(self._feature_bounds[1], index=self._feature_name_list)
 
     @property
     def _feature_min(self):
-        return self._nn1._feature_min.combine(self._nn2._feature_min, max)
+        return _pandas().Series(self._feature_bounds[0], index=self._feature_name_list)
+
+class QuaLiKizNDNN(QuaLiKizNN):
+    _feature_names = _LazySeries('_feature_names')
+    _target_names = _LazySeries('_target_names')
+    _feature_min = _LazySeries('_feature_min', '_feature_names')
+    _feature_max = _LazySeries('_feature_max', '_feature_names')
+    _target_min = _LazySeries('_target_min', '_target_names')
+    _target_max = _LazySeries('_target_max', '_target_names')
+    _feature_prescale_factor = _LazySeries('_feature_prescale_factor', '_feature_names')
+    _feature_prescale_bias = _LazySeries('_feature_prescale_bias', '_feature_names')
+    _target_prescale_factor = _LazySeries('_target_prescale_factor', '_target_names')
+    _target_prescale_bias = _LazySeries('_target_prescale_bias', '_target_names')
 
-class QuaLiKizNDNN():
-    def __init__(self, nn_dict, target_names_mask=None, layer_mode=None):
+    def __init__(self, nn_dict, target_names_mask=None, layer_mode=None, precision='float64'):
         """ General ND fully-connected multilayer perceptron neural network
 
         Initialize this class using a nn_dict. This dict is usually read
         directly from JSON, and has a specific structure. Generate this JSON
         file using the supplied function in QuaLiKiz-Tensorflow
+
+        precision selects the floating point type used for inference:
+        'float64', 'float32', or 'mixed' for float32 hidden layers and a
+        float64 output layer. The output is always float64. Only the
+        classic layer_mode supports reduced precision.
+
+        layer_mode 'auto' times all available backends on a range of batch
+        sizes once per host and topology (see autotune.py), and evaluates
+        every call with the fastest backend for its number of rows.
+
+        layer_mode 'numba' evaluates the network in a fused kernel compiled
+        for its topology (see numba_ndnn.py). Without numba it falls back
+        to 'classic' with a warning.
         """
         parsed = {}
+        auto = layer_mode == 'auto'
+        if auto:
+            if precision != 'float64':
+                raise Exception('precision {!s} not supported for layer_mode auto'.format(precision))
+            # The classic layers are used for plans and the Jacobian
+            layer_mode = 'classic'
+        if precision not in ['float64', 'float32', 'mixed']:
+            raise Exception('Unknown precision {!s}'.format(precision))
+        if precision != 'float64':
+            if layer_mode is None:
+                layer_mode = 'classic'
+            elif layer_mode != 'classic':
+                raise Exception('precision {!s} not supported for layer_mode {!s}'.format(precision, layer_mode))
         if layer_mode is None:
             try:
                 import qlknn
@@ -192,6 +993,13 @@ class QuaLiKizNDNN():
             import qlknn
         elif layer_mode == 'cython':
             import cython_mkl_ndnn
+        elif layer_mode == 'numba':
+            try:
+                import numba_ndnn
+            except ImportError:
+                warn('numba not available, falling back to layer_mode classic')
+                layer_mode = 'classic'
+        self._layer_mode = layer_mode
 
         # Read and parse the json. E.g. put arrays in arrays and the rest in a dict
         for name, value in nn_dict.items():
@@ -199,34 +1007,52 @@ class QuaLiKizNDNN():
                 parsed[name] = value
             elif value.__class__ == list:
                 parsed[name] = np.array(value)
+            elif isinstance(value, np.ndarray):
+                # E.g. memory-mapped weights from a binary network file
+                parsed[name] = value
             else:
                 parsed[name] = dict(value)
-        # These variables do not depend on the amount of layers in the NN
+        # These variables do not depend on the amount of layers in the NN.
+        # They are kept as arrays, see _LazySeries
+        arrays = self._arrays = {}
         for set in ['feature', 'target']:
-            setattr(self, '_' + set + '_names', pd.Series(parsed.pop(set + '_names')))
+            arrays['_' + set + '_names'] = [str(name) for name in parsed.pop(set + '_names')]
         for set in ['feature', 'target']:
+            names = arrays['_' + set + '_names']
             for subset in ['min', 'max']:
-                setattr(self, '_'.join(['', set, subset]), pd.Series(parsed.pop('_'.join([set, subset])))[getattr(self, '_' + set + '_names')])
+                values = parsed.pop('_'.join([set, subset]))
+                arrays['_'.join(['', set, subset])] = np.array([values[name] for name in names], dtype='float64')
         for subset in ['bias', 'factor']:
-            setattr(self, '_'.join(['_feature_prescale', subset]), pd.Series(parsed['prescale_' + subset])[self._feature_names])
-            setattr(self, '_'.join(['_target_prescale', subset]), pd.Series(parsed.pop('prescale_' + subset))[self._target_names])
+            values = parsed['prescale_' + subset]
+            arrays['_'.join(['_feature_prescale', subset])] = np.array(
+                [values[name] for name in arrays['_feature_names']], dtype='float64')
+            values = parsed.pop('prescale_' + subset)
+            arrays['_'.join(['_target_prescale', subset])] = np.array(
+                [values[name] for name in arrays['_target_names']], dtype='float64')
         self.layers = []
+        self._layer_activations = []
         # Now find out the amount of layers in our NN, and save the weigths and biases
         activations = parsed['hidden_activation'] + [parsed['output_activation']]
+        if precision == 'float64':
+            dtypes = ['float64'] * len(activations)
+        elif precision == 'float32':
+            dtypes = ['float32'] * len(activations)
+        elif precision == 'mixed':
+            dtypes = ['float32'] * (len(activations) - 1) + ['float64']
+        self._precision = precision
         for ii in range(1, len(activations) + 1):
             try:
                 name = 'layer' + str(ii)
-                weight = parsed.pop(name + '/weights/Variable:0')
-                bias = parsed.pop(name + '/biases/Variable:0')
+                # Does not copy if the weights already have the right type,
+                # e.g. memory-mapped weights from a binary network file
+                weight = parsed.pop(name + '/weights/Variable:0').astype(dtypes[ii - 1], copy=False)
+                bias = parsed.pop(name + '/biases/Variable:0').astype(dtypes[ii - 1], copy=False)
                 activation = activations.pop(0)
-                if layer_mode == 'classic':
-                    if activation == 'tanh':
-                        act = np.tanh
-                    elif activation == 'relu':
-                        act = _act_relu
-                    elif activation == 'none':
-                        act = _act_none
-                    self.layers.append(QuaLiKizNDNN.NNLayer(weight, bias, act))
+                act = get_activation(activation)
+                self._layer_activations.append(activation)
+                if layer_mode in ['classic', 'numba']:
+                    # The preactivation is a fresh array, so it can be overwritten
+                    self.layers.append(QuaLiKizNDNN.NNLayer(weight, bias, act.apply_inplace))
                 elif layer_mode  == 'intel':
                     self.layers.append(qlknn.Layer(weight, bias, activation))
                 elif layer_mode  == 'cython':
@@ -244,6 +1070,35 @@ class QuaLiKizNDNN():
             self._clip_bounds = False
 
         self._target_names_mask = target_names_mask
+        self._update_target_bounds()
+        # Inputs are prescaled in the precision of the first layer,
+        # outputs are always descaled in float64
+        self._input_dtype = np.dtype(dtypes[0])
+        self._prescale_arrays = (
+            np.ascontiguousarray(arrays['_feature_prescale_factor'], dtype=self._input_dtype),
+            np.ascontiguousarray(arrays['_feature_prescale_bias'], dtype=self._input_dtype),
+            np.ascontiguousarray(arrays['_target_prescale_factor'], dtype='float64'),
+            np.ascontiguousarray(arrays['_target_prescale_bias'], dtype='float64'))
+        self._plan = None
+        self._network = None
+        if layer_mode == 'intel':
+            # Prescale, all layers and descale in one C call without the GIL
+            self._network = qlknn.Network([layer._weights for layer in self.layers],
+                                          [layer._biases for layer in self.layers],
+                                          self._layer_activations,
+                                          *self._prescale_arrays)
+        elif layer_mode == 'numba':
+            # Fused prescale, layers, descale and clip. The classic layers
+            # are kept for apply_layers, plans and the Jacobian.
+            self._network = numba_ndnn.Network([layer._weights for layer in self.layers],
+                                               [layer._biases for layer in self.layers],
+                                               self._layer_activations,
+                                               *self._prescale_arrays)
+        self._dispatcher = None
+        if auto:
+            from autotune import BackendDispatcher
+            self._layer_mode = 'auto'
+            self._dispatcher = BackendDispatcher(self, nn_dict)
         # Ignore metadata
         try:
             self._metadata = parsed.pop('_metadata')
@@ -252,18 +1107,27 @@ class QuaLiKizNDNN():
         if any(parsed):
             warn('nn_dict not fully parsed! ' + str(parsed))
 
+    @property
+    def _feature_name_list(self):
+        return self._arrays['_feature_names']
+
+    @property
+    def _target_name_list(self):
+        return self._arrays['_target_names']
+
+    def _compute_feature_bounds(self):
+        return (self._arrays['_feature_min'].copy(), self._arrays['_feature_max'].copy())
+
+    def _update_target_bounds(self):
+        self._target_bounds_cache = (_fill_unknown(self._arrays['_target_min'], -np.inf),
+                                     _fill_unknown(self._arrays['_target_max'], np.inf))
+
     def apply_layers(self, input, output=None):
         """ Apply all NN layers to the given input
 
         The given input has to be array-like, but can be of size 1
         """
         input = np.ascontiguousarray(input)
-        # 3x30 network:
-        #14.1 µs ± 913 ns per loop (mean ± std. dev. of 7 runs, 100000 loops each)
-        #20.9 µs ± 2.43 µs per loop (mean ± std. dev. of 7 runs, 100000 loops each)
-        #19.1 µs ± 240 ns per loop (mean ± std. dev. of 7 runs, 10000 loops each)
-        #2.67 µs ± 29.7 ns per loop (mean ± std. dev. of 7 runs, 100000 loops each)
-
         for layer in self.layers:
             output = np.empty([input.shape[0], layer._weights.shape[1]])
             output = layer.apply(input, output)
@@ -284,13 +1148,6 @@ class QuaLiKizNDNN():
             self._weights = weight
             self._biases = bias
             self._activation = activation
-            #@jit(float64[:,:](float64[:,:]), nopython=True)
-            #def _apply_layer(input):
-            #    preactivation = np.dot(input, weight) + bias
-            #    result = activation(preactivation)
-            #    return result
-            #self.apply = lambda input: activation(np.dot(input, weight) + bias)
-            #_create_apply(weight, bias, activation)
 
         def apply(self, input, output=None):
             preactivation = np.dot(input, self._weights) + self._biases
@@ -311,34 +1168,218 @@ class QuaLiKizNDNN():
         at least the feature_names) and as values 1xN same-length
         arrays.
         """
-        #49.1 ns ± 1.53 ns per loop (mean ± std. dev. of 7 runs, 10000000 loops each)
+        timer = nn_profiling.StageTimer('QuaLiKizNDNN', len(input)) if nn_profiling.ENABLED else None
         nn_input, safe, clip_low, clip_high, low_bound, high_bound = \
             determine_settings(self, input, safe, clip_low, clip_high, low_bound, high_bound)
-
-        #nn_input = self._feature_prescale_factors.values[np.newaxis, :] * nn_input + self._feature_prescale_biases.values
-        #14.3 µs ± 1.08 µs per loop (mean ± std. dev. of 7 runs, 100000 loops each)
-        nn_input = _prescale(nn_input,
-                             self._feature_prescale_factor.values,
-                             self._feature_prescale_bias.values)
+        nn_input = self._check_domain(nn_input)
+        if timer is not None:
+            timer.lap('determine_settings')
 
         # Apply all NN layers an re-scale the outputs
-        # 104 µs ± 19.7 µs per loop (mean ± std. dev. of 7 runs, 10000 loops each)
-        # 70.9 µs ± 384 ns per loop (mean ± std. dev. of 7 runs, 10000 loops each) (only apply layers)
-        output = (self.apply_layers(nn_input) - np.atleast_2d(self._target_prescale_bias)) / np.atleast_2d(self._target_prescale_factor)
+        if timer is not None and self._plan is None and self._dispatcher is None and self._network is None:
+            # Time prescale, apply_layers and descale separately
+            output = self._predict_layers(nn_input, timer=timer)
+        else:
+            output = self._predict(nn_input)
+            if timer is not None:
+                timer.lap('predict')
         #for name in self._target_names:
         #    nn_output = (np.squeeze(self.apply_layers(nn_input)) - self._target_prescale_biases[name]) / self._target_prescale_factors[name]
         #    output[name] = nn_output
         output = clip_to_bounds(output, clip_low=clip_low, clip_high=clip_high, low_bound=low_bound, high_bound=high_bound)
+        if timer is not None:
+            timer.lap('clip_to_bounds')
 
-        # 118 µs ± 3.83 µs per loop (mean ± std. dev. of 7 runs, 10000 loops each)
         if output_pandas:
-            output = pd.DataFrame(output, columns=self._target_names)
-
-        # 47.4 ns ± 1.79 ns per loop (mean ± std. dev. of 7 runs, 10000000 loops each)
-        if self._target_names_mask is not None:
-            output.columns = self._target_names_mask
+            output = _pandas().DataFrame(output, columns=self._target_names)
+            if self._target_names_mask is not None:
+                output.columns = self._target_names_mask
+        if timer is not None:
+            timer.lap('to_pandas')
+            timer.done()
         return output
 
+    def specialise(self, fixed, **kwargs):
+        """ Network of the remaining features, with the features in fixed held constant
+
+        fixed is a dict of feature name -> value. The contribution of the
+        fixed features to the first layer is folded into its bias, so the
+        specialised network only prescales and multiplies the free features,
+        e.g. the scanned dimension of a 1D scan. kwargs are passed to
+        QuaLiKizNDNN; layer_mode and precision default to those of this network.
+        """
+        feature_names = self._feature_name_list
+        unknown = [name for name in fixed if name not in feature_names]
+        if len(unknown) > 0:
+            raise Exception('Cannot fix unknown features {!s}'.format(unknown))
+        free = [ii for ii, name in enumerate(feature_names) if name not in fixed]
+        held = [ii for ii, name in enumerate(feature_names) if name in fixed]
+        if len(free) == 0:
+            raise Exception('Cannot fix all features')
+        arrays = self._arrays
+        free_names = [feature_names[ii] for ii in free]
+        target_names = self._target_name_list
+        # Prescaled values of the fixed features times their first layer weights
+        held_values = np.array([fixed[feature_names[ii]] for ii in held], dtype='float64')
+        held_input = (held_values * arrays['_feature_prescale_factor'][held] +
+                      arrays['_feature_prescale_bias'][held])
+        first_weights = np.asarray(self.layers[0]._weights, dtype='float64')
+        first_bias = np.ravel(np.asarray(self.layers[0]._biases, dtype='float64')) + np.dot(held_input, first_weights[held])
+
+        nn_dict = {
+            'feature_names': free_names,
+            'target_names': target_names,
+            'hidden_activation': self._layer_activations[:-1],
+            'output_activation': self._layer_activations[-1],
+        }
+        for subset in ['min', 'max']:
+            nn_dict['feature_' + subset] = dict(zip(free_names, arrays['_feature_' + subset][free]))
+            nn_dict['target_' + subset] = dict(zip(target_names, arrays['_target_' + subset]))
+        for subset in ['factor', 'bias']:
+            prescale = dict(zip(free_names, arrays['_feature_prescale_' + subset][free]))
+            prescale.update(zip(target_names, arrays['_target_prescale_' + subset]))
+            nn_dict['prescale_' + subset] = prescale
+        for ii, layer in enumerate(self.layers, 1):
+            if ii == 1:
+                weights, biases = first_weights[free], first_bias
+            else:
+                weights, biases = np.asarray(layer._weights), np.ravel(np.asarray(layer._biases))
+            nn_dict['layer{:d}/weights/Variable:0'.format(ii)] = weights
+            nn_dict['layer{:d}/biases/Variable:0'.format(ii)] = biases
+        if hasattr(self, '_metadata'):
+            nn_dict['_metadata'] = dict(self._metadata, fixed_features=dict(fixed))
+        kwargs.setdefault('layer_mode', self._layer_mode)
+        kwargs.setdefault('precision', self._precision)
+        kwargs.setdefault('target_names_mask', self._target_names_mask)
+        return QuaLiKizNDNN(nn_dict, **kwargs)
+
+    def compile_plan(self, fold=True, max_workspaces=8):
+        """ Compile this network into an InferencePlan
+
+        After compilation get_output evaluates the network using the plan.
+        Call clear_plan to go back to layer-by-layer evaluation.
+        """
+        self._plan = InferencePlan(self, fold=fold, max_workspaces=max_workspaces)
+        return self._plan
+
+    def clear_plan(self):
+        self._plan = None
+
+    def _combine(self, leaf_outputs, out=None):
+        if out is None:
+            return leaf_outputs[id(self)]
+        out[...] = leaf_outputs[id(self)]
+        return out
+
+    def _predict_jacobian(self, input, features):
+        """ Unclipped output and its derivatives to the features named in features """
+        feature_names = self._feature_name_list
+        selected = [feature_names.index(name) for name in features]
+        feature_factor, feature_bias, target_factor, target_bias = self._prescale_arrays
+        input = np.asarray(input, dtype=self._input_dtype)
+        layer_input = _prescale(input, feature_factor, feature_bias)
+        for ii, (layer, activation) in enumerate(zip(self.layers, self._layer_activations)):
+            weights = np.asarray(layer._weights)
+            preactivation = np.dot(layer_input, weights) + np.ravel(layer._biases)
+            if ii == 0:
+                # The derivative of the prescaled input is the same for all rows,
+                # so the first tangent is (n_selected, n_neurons) for all rows
+                tangent = feature_factor[selected, np.newaxis] * weights[selected, :]
+            else:
+                tangent = np.matmul(tangent, weights)
+            act = ACTIVATIONS[activation]
+            layer_input = act.apply(preactivation)
+            tangent = tangent * act.derivative(preactivation, layer_input)[:, np.newaxis, :]
+        output = (layer_input - target_bias) / target_factor
+        # (n_rows, n_selected, n_targets) -> (n_rows, n_targets, n_selected)
+        jacobian = np.transpose(tangent / target_factor, (0, 2, 1))
+        return output.astype('float64', copy=False), jacobian.astype('float64', copy=False)
+
+    def predict_array(self, input, out=None, clip_low=True, clip_high=True):
+        if self._layer_mode == 'numba' and self._plan is None:
+            # Clip inside the fused kernel
+            low_bound, high_bound = self._target_bounds
+            return self._network.apply(self._order_input(input), out,
+                                       clip_low, clip_high, low_bound, high_bound)
+        return QuaLiKizNN.predict_array(self, input, out=out, clip_low=clip_low, clip_high=clip_high)
+    predict_array.__doc__ = QuaLiKizNN.predict_array.__doc__
+
+    def _predict(self, input, out=None):
+        """ Prescale, apply all layers and descale. Does not clip """
+        if self._plan is not None:
+            # Prescale, all layers and descale in one pass
+            return self._plan.apply(input, out=out)
+        if self._dispatcher is not None:
+            return self._dispatcher.predict(input, out)
+        if self._network is not None:
+            if (self._layer_mode == 'intel' and out is not None
+                    and not (out.dtype == np.float64 and out.flags['C_CONTIGUOUS'])):
+                # qlknn.Network only writes C-contiguous doubles
+                out[...] = self._network.apply(input, None)
+                return out
+            return self._network.apply(input, out)
+        return self._predict_layers(input, out=out)
+
+    def _sweep(self, bases, index, values):
+        feature_factor, feature_bias, target_factor, target_bias = self._prescale_arrays
+        weights = np.asarray(self.layers[0]._weights, dtype='float64')
+        biases = np.ravel(np.asarray(self.layers[0]._biases, dtype='float64'))
+        base_input = bases * feature_factor + feature_bias
+        # Preactivation of the bases without the swept feature, plus that of
+        # every prescaled value times its row of weights
+        base_input[:, index] = 0
+        base_preactivation = np.dot(base_input, weights) + biases
+        swept_preactivation = np.outer(values * feature_factor[index] + feature_bias[index], weights[index])
+        # Every layer keeps its own precision, as in InferencePlan
+        first_dtype = dtype = np.asarray(self.layers[0]._weights).dtype
+        layers = []
+        for layer, activation in zip(self.layers[1:], self._layer_activations[1:]):
+            layer_weights = np.asarray(layer._weights)
+            dtype = np.result_type(dtype, layer_weights)
+            layers.append((layer_weights, np.ravel(np.asarray(layer._biases, dtype=dtype)),
+                           ACTIVATIONS[activation], dtype))
+        n_values = len(values)
+        out = np.empty((len(bases) * n_values, len(self._target_name_list)))
+        # Evaluate whole sweeps in tiles of about CHUNK_SIZE rows, which keep
+        # the hidden layers in cache, on buffers reused between tiles
+        step = max(1, CHUNK_SIZE // max(1, n_values))
+        buffers = {}
+        for start in range(0, len(bases), step):
+            stop = min(start + step, len(bases))
+            layer_input = base_preactivation[start:stop, np.newaxis, :] + swept_preactivation
+            layer_input = np.reshape(layer_input, (-1, weights.shape[1]))
+            ACTIVATIONS[self._layer_activations[0]].apply_inplace(layer_input)
+            layer_input = layer_input.astype(first_dtype, copy=False)
+            for ii, (layer_weights, layer_biases, activation, layer_dtype) in enumerate(layers):
+                shape = (layer_input.shape[0], layer_weights.shape[1])
+                if buffers.get(ii) is None or buffers[ii].shape != shape:
+                    buffers[ii] = np.empty(shape, dtype=layer_dtype)
+                layer_input = np.dot(layer_input, layer_weights, out=buffers[ii])
+                layer_input += layer_biases
+                activation.apply_inplace(layer_input)
+            out[start * n_values:stop * n_values] = layer_input
+        out -= target_bias
+        out /= target_factor
+        return out
+
+    def _predict_layers(self, input, out=None, timer=None):
+        """ Prescale, apply all layers and descale, layer by layer """
+        feature_factor, feature_bias, target_factor, target_bias = self._prescale_arrays
+        input = np.asarray(input, dtype=self._input_dtype)
+        nn_input = _prescale(input, feature_factor, feature_bias)
+        if timer is not None:
+            timer.lap('prescale')
+        output = self.apply_layers(nn_input)
+        if timer is not None:
+            timer.lap('apply_layers')
+        output = (output - np.atleast_2d(target_bias)) / np.atleast_2d(target_factor)
+        if timer is not None:
+            timer.lap('descale')
+        if out is None:
+            return output
+        out[...] = output
+        return out
+
     @classmethod
     def from_json(cls, json_file, **kwargs):
         with open(json_file) as file_:
@@ -346,6 +1387,40 @@ class QuaLiKizNDNN():
         nn = QuaLiKizNDNN(dict_, **kwargs)
         return nn
 
+    @classmethod
+    def from_binary(cls, binary_file, mmap=True, **kwargs):
+        from nn_io import load_binary
+        nn = QuaLiKizNDNN(load_binary(binary_file, mmap=mmap), **kwargs)
+        return nn
+
+    @classmethod
+    def from_file(cls, nn_file, **kwargs):
+        """ Load from a JSON or binary network file, detected by content """
+        from nn_io import load_nn_dict
+        nn = QuaLiKizNDNN(load_nn_dict(nn_file), **kwargs)
+        return nn
+
+    @property
+    def _fingerprint(self):
+        """ Hash of everything that determines the output of the network
+
+        Computed on first use; the network should not be modified after.
+        """
+        fingerprint = self.__dict__.get('_fingerprint_cache')
+        if fingerprint is None:
+            sha = hashlib.sha1()
+            sha.update(json.dumps([self._feature_name_list, self._target_name_list,
+                                   self._layer_activations]).encode('utf-8'))
+            for array in self._prescale_arrays:
+                sha.update(np.ascontiguousarray(array).tobytes())
+            for layer in self.layers:
+                for array in [layer._weights, layer._biases]:
+                    array = np.ascontiguousarray(array)
+                    sha.update(array.dtype.str.encode('utf-8'))
+                    sha.update(array.tobytes())
+            fingerprint = self._fingerprint_cache = sha.hexdigest()
+        return fingerprint
+
     @property
     def l2_norm(self):
         l2_norm = 0
@@ -361,21 +1436,489 @@ class QuaLiKizNDNN():
             l1_norm += np.sum(np.abs(layer.weight))
         return l1_norm
 
-def clip_to_bounds(output, clip_low, clip_high, low_bound, high_bound):
+class _WorkspaceCache(threading.local):
+    """ Per-thread cache of the workspaces of the most recent batch sizes
+
+    Every thread gets its own workspaces, so a plan can be applied from
+    several threads at once.
+    """
+    def __init__(self, create, max_workspaces):
+        self._create = create
+        self._max_workspaces = max_workspaces
+        self._workspaces = OrderedDict()
+
+    def get(self, n_rows):
+        try:
+            workspace = self._workspaces[n_rows]
+            self._workspaces.move_to_end(n_rows)
+        except KeyError:
+            workspace = self._create(n_rows)
+            self._workspaces[n_rows] = workspace
+            if len(self._workspaces) > self._max_workspaces:
+                self._workspaces.popitem(last=False)
+        return workspace
+
+class InferencePlan():
+    """ Fused single-pass evaluator for a QuaLiKizNDNN
+
+    With fold=True the feature prescaling is folded into the weights and
+    biases of the first layer, and the target descaling into the last
+    layer if that layer has a linear ('none') activation. The layers are
+    then evaluated with in-place np.dot/activation calls on workspaces that
+    are allocated once per batch size and re-used, so a call only allocates
+    the returned array (and nothing at all if `out` is given).
+
+    With fold=False the prescaling and descaling are done in separate
+    in-place steps. This gives results bit-for-bit equal to the classic
+    layer-by-layer path, at the cost of one extra pass over the input and
+    the output. Folding changes the rounding, but only at the level of
+    floating point precision.
+    """
+    def __init__(self, network, fold=True, max_workspaces=8):
+        self._fold = fold
+        self._workspaces = _WorkspaceCache(self._create_workspace, max_workspaces)
+
+        # Fold in float64, then go back to the precision of the network
+        dtypes = [np.asarray(layer._weights).dtype for layer in network.layers]
+        weights = [np.array(layer._weights, dtype='float64') for layer in network.layers]
+        biases = [np.array(layer._biases, dtype='float64').ravel() for layer in network.layers]
+        self._activations = list(network._layer_activations)
+        self._kernels = [ACTIVATIONS[name].apply_inplace for name in self._activations]
+        self._feature_factor = network._arrays['_feature_prescale_factor'].astype('float64')
+        self._feature_bias = network._arrays['_feature_prescale_bias'].astype('float64')
+        self._target_factor = network._arrays['_target_prescale_factor'].astype('float64')
+        self._target_bias = network._arrays['_target_prescale_bias'].astype('float64')
+
+        self._descale = True
+        if fold:
+            # (factor * x + bias) . W + b = x . (factor^T * W) + (bias . W + b)
+            biases[0] = np.dot(self._feature_bias, weights[0]) + biases[0]
+            weights[0] = self._feature_factor[:, np.newaxis] * weights[0]
+            if self._activations[-1] == 'none':
+                # (x . W + b - tbias) / tfactor = x . (W / tfactor) + (b - tbias) / tfactor
+                weights[-1] = weights[-1] / self._target_factor
+                biases[-1] = (biases[-1] - self._target_bias) / self._target_factor
+                self._descale = False
+        self._weights = [np.ascontiguousarray(weight, dtype=dtype) for weight, dtype in zip(weights, dtypes)]
+        self._biases = [bias.astype(dtype) for bias, dtype in zip(biases, dtypes)]
+        self._input_dtype = dtypes[0]
+        if not fold:
+            self._feature_factor = self._feature_factor.astype(self._input_dtype)
+            self._feature_bias = self._feature_bias.astype(self._input_dtype)
+        # Type of the result of every layer
+        self._dtypes = []
+        dtype = self._input_dtype
+        for weight in self._weights:
+            dtype = np.result_type(dtype, weight)
+            self._dtypes.append(dtype)
+        self._n_features = self._weights[0].shape[0]
+        self._n_targets = self._weights[-1].shape[1]
+
+    def _create_workspace(self, n_rows):
+        workspace = []
+        if not self._fold:
+            workspace.append(np.empty((n_rows, self._n_features), dtype=self._input_dtype))
+        for weight, dtype in zip(self._weights, self._dtypes):
+            workspace.append(np.empty((n_rows, weight.shape[1]), dtype=dtype))
+        return workspace
+
+    def apply(self, input, out=None):
+        """ Evaluate the network on unscaled input
+
+        Returns the descaled, unclipped output. If `out` is given the result
+        is written into it, otherwise a new array is allocated.
+        """
+        input = np.ascontiguousarray(input, dtype=self._input_dtype)
+        n_rows = input.shape[0]
+        workspace = self._workspaces.get(n_rows)
+        if out is None:
+            out = np.empty((n_rows, self._n_targets))
+        if out.flags.c_contiguous and out.dtype == self._dtypes[-1]:
+            last = out
+        else:
+            last = workspace[-1]
+
+        if self._fold:
+            buffers = workspace
+        else:
+            np.multiply(self._feature_factor, input, out=workspace[0])
+            np.add(workspace[0], self._feature_bias, out=workspace[0])
+            input = workspace[0]
+            buffers = workspace[1:]
+
+        n_layers = len(self._weights)
+        for ii, (weight, bias, activation) in enumerate(zip(self._weights, self._biases, self._kernels)):
+            if ii == n_layers - 1:
+                result = last
+            else:
+                result = buffers[ii]
+            np.dot(input, weight, out=result)
+            result += bias
+            activation(result)
+            input = result
+
+        if result is not out:
+            out[...] = result
+        if self._descale:
+            np.subtract(out, self._target_bias, out=out)
+            np.divide(out, self._target_factor, out=out)
+        return out
+
+class StackedPlan():
+    """ Evaluate an ensemble of QuaLiKizNDNNs with one matmul per layer
+
+    Networks with the same feature names, layer sizes and activations are
+    packed into a group. The (prescale-folded) weights of a group are
+    stacked in 3D tensors of shape (n_networks, n_in, n_out), so that every
+    layer of the whole group is a single batched np.matmul. Networks that
+    appear more than once, or have the same weights, are only evaluated once.
+
+    apply returns a dict mapping id(network) to its descaled, unclipped
+    output. `feature_names` is the column order of the input passed to apply.
+    """
+    def __init__(self, networks, feature_names, max_workspaces=8):
+        self._workspaces = _WorkspaceCache(self._create_workspace, max_workspaces)
+        feature_names = list(feature_names)
+        self._networks, self._aliases = _unique_leaves(networks)
+
+        groups = OrderedDict()
+        for nn in self._networks:
+            key = (tuple(nn._feature_name_list),
+                   tuple((np.shape(layer._weights), np.asarray(layer._weights).dtype) for layer in nn.layers),
+                   tuple(nn._layer_activations))
+            groups.setdefault(key, []).append(nn)
+
+        self._groups = []
+        for (group_features, _, activations), nns in groups.items():
+            plans = [InferencePlan(nn, fold=True) for nn in nns]
+            permutation = [feature_names.index(name) for name in group_features]
+            if permutation == list(range(len(feature_names))):
+                permutation = None
+            group = {
+                'ids': [id(nn) for nn in nns],
+                'permutation': permutation,
+                'kernels': [ACTIVATIONS[name].apply_inplace for name in activations],
+                'weights': [np.stack([plan._weights[ii] for plan in plans])
+                            for ii in range(len(activations))],
+                'biases': [np.stack([plan._biases[ii] for plan in plans])[:, np.newaxis, :]
+                           for ii in range(len(activations))],
+                'input_dtype': plans[0]._input_dtype,
+                'dtypes': plans[0]._dtypes,
+                'descale': plans[0]._descale,
+                'target_bias': np.stack([plan._target_bias for plan in plans])[:, np.newaxis, :],
+                'target_factor': np.stack([plan._target_factor for plan in plans])[:, np.newaxis, :],
+            }
+            self._groups.append(group)
+
+    def _create_workspace(self, n_rows):
+        return [[np.empty((weight.shape[0], n_rows, weight.shape[2]), dtype=dtype)
+                 for weight, dtype in zip(group['weights'][:-1], group['dtypes'])]
+                for group in self._groups]
+
+    def apply(self, input):
+        input = np.asarray(input)
+        n_rows = input.shape[0]
+        workspace = self._workspaces.get(n_rows)
+        outputs = {}
+        for group, buffers in zip(self._groups, workspace):
+            group_input = np.ascontiguousarray(_permute(input, group['permutation']),
+                                               dtype=group['input_dtype'])
+            last_weight = group['weights'][-1]
+            buffers = buffers + [np.empty((last_weight.shape[0], n_rows, last_weight.shape[2]),
+                                          dtype=group['dtypes'][-1])]
+            # The first layer broadcasts the shared 2D input over all networks
+            layer_input = group_input
+            for weight, bias, activation, result in zip(group['weights'], group['biases'],
+                                                        group['kernels'], buffers):
+                np.matmul(layer_input, weight, out=result)
+                result += bias
+                activation(result)
+                layer_input = result
+            # Outputs are always float64
+            result = result.astype('float64', copy=False)
+            if group['descale']:
+                result -= group['target_bias']
+                result /= group['target_factor']
+            for ii, nn_id in enumerate(group['ids']):
+                outputs[nn_id] = result[ii]
+        for alias, nn_id in self._aliases.items():
+            outputs[alias] = outputs[nn_id]
+        return outputs
+
+def _leaf_networks(network):
+    """ All QuaLiKizNDNNs a (combined) network is built from """
+    if isinstance(network, QuaLiKizNDNN):
+        return [network]
+    elif isinstance(network, QuaLiKizDuoNN):
+        children = [network._nn1, network._nn2]
+    else:
+        children = network._nns
+    return flatten([_leaf_networks(nn) for nn in children])
+
+def _output_labels(network):
+    """ Column names of the DataFrame returned by network.get_output """
+    target_names_mask = getattr(network, '_target_names_mask', None)
+    if target_names_mask is not None:
+        return list(target_names_mask)
+    return network._target_name_list
+
+def _unique_leaves(networks):
+    """ Distinct networks, and a dict mapping id(duplicate) to id(its distinct network)
+
+    Networks are the same if they are the same object or have the same
+    _fingerprint, e.g. the same network loaded twice.
+    """
+    unique = OrderedDict()
+    aliases = {}
+    for nn in networks:
+        first = unique.setdefault(nn._fingerprint, nn)
+        if first is not nn:
+            aliases[id(nn)] = id(first)
+    return list(unique.values()), aliases
+
+def compare_precision(reference, network, input):
+    """ Deviation of the unclipped output of network from that of reference
+
+    Typically reference is a float64 network and network the same network
+    loaded with a reduced precision. Returns a DataFrame with the maximum
+    absolute and the RMS deviation per target.
+    """
+    input = reference._order_input(input)
+    reference_output = reference._predict(input)
+    output = network._predict(input)
+    deviation = output - reference_output
+    return _pandas().DataFrame({'max_deviation': np.max(np.abs(deviation), axis=0),
+                         'rms_deviation': np.sqrt(np.mean(np.square(deviation), axis=0))},
+                        index=reference._target_name_list)
+
+def _bracketed_newton(evaluate, low, high, f_low, f_high, xtol=1e-6, max_iter=50):
+    """ Vectorised root finding of many functions on brackets [low, high]
+
+    f_low and f_high are the function values on the brackets, of which
+    exactly one should be positive. evaluate(x, active) returns the values
+    and derivatives of the functions with indices active at x. Every
+    iteration takes a Newton step, or bisects if that leaves the bracket
+    or is not at most half the previous step (as rtsafe in Numerical
+    Recipes), and evaluates only the functions that did not converge yet. The
+    brackets are kept on the boundary between f <= 0 and f > 0, so the
+    point where a clipped function leaves zero is found as well. Converged
+    are the roots within xtol; after max_iter iterations the last estimate
+    is returned.
+    """
+    low = np.array(low, dtype='float64')
+    high = np.array(high, dtype='float64')
+    f_low = np.asarray(f_low, dtype='float64')
+    f_high = np.asarray(f_high, dtype='float64')
+    low_above = f_low > 0
+    # Start on the secant through the bracket
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = low - f_low * (high - low) / (f_high - f_low)
+    x = np.where((x > low) & (x < high), x, 0.5 * (low + high))
+    active = np.arange(len(x))
+    previous_step = high - low
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        x_active = x[active]
+        f, df = evaluate(x_active, active)
+        # Shrink the brackets to the side with the sign change
+        same_side = (f > 0) == low_above[active]
+        low[active] = np.where(same_side, x_active, low[active])
+        high[active] = np.where(same_side, high[active], x_active)
+        low_active, high_active = low[active], high[active]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = x_active - f / df
+        step = np.abs(newton - x_active)
+        # A small step may end on the bracket, when x is (close to) the root
+        small = (newton >= low_active) & (newton <= high_active) & (step <= 0.5 * xtol)
+        inside = small | ((newton > low_active) & (newton < high_active) &
+                          (step <= 0.5 * previous_step[active]))
+        x_new = np.where(inside, newton, 0.5 * (low_active + high_active))
+        x[active] = x_new
+        previous_step[active] = np.abs(x_new - x_active)
+        converged = small | (high_active - low_active <= xtol)
+        active = active[~converged]
+    return x
+
+def _clip_jacobian(output, jacobian, clip_low, clip_high, low_bound, high_bound):
+    """ Clip output in-place, and zero the derivatives of the clipped elements """
+    clipped = np.zeros(output.shape, dtype='bool')
     if clip_low:
-        for ii, bound in enumerate(low_bound):
-            output[:, ii][output[:, ii] < bound] = bound
+        clipped |= output < np.ravel(low_bound)
+    if clip_high:
+        clipped |= output > np.ravel(high_bound)
+    if np.any(clipped):
+        jacobian = np.array(jacobian)
+        jacobian[clipped] = 0
+    output = clip_to_bounds(output, clip_low, clip_high, low_bound, high_bound)
+    return output, jacobian
+
+class _Dual():
+    """ Forward-mode dual number: an output array and its derivatives
+
+    value has shape (n_rows, n_targets) and grad (n_rows, n_targets,
+    n_features). Supports the arithmetic used in combo functions
+    (+, -, *, /, **, abs and indexing), so a combo_func called with _Duals returns
+    the combined output together with its derivatives. If columns is given,
+    a target can also be selected by name, as a column of a DataFrame.
+    """
+    # Make NumPy defer to the reflected operators below
+    __array_ufunc__ = None
+
+    def __init__(self, value, grad, columns=None):
+        self.value = value
+        self.grad = grad
+        self.columns = columns
+
+    @staticmethod
+    def _split(other):
+        if isinstance(other, _Dual):
+            return other.value, other.grad
+        return np.asarray(other), None
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and self.columns is not None:
+            ii = self.columns.index(key)
+            return _Dual(self.value[:, ii], self.grad[:, ii])
+        # Index the rows and targets, the derivatives are on the last axis
+        return _Dual(self.value[key], self.grad[key])
+
+    def __add__(self, other):
+        value, grad = _Dual._split(other)
+        if grad is None:
+            return _Dual(self.value + value, self.grad)
+        return _Dual(self.value + value, self.grad + grad)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return _Dual(-self.value, -self.grad)
+
+    def __pos__(self):
+        return self
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        value, grad = _Dual._split(other)
+        result = self.grad * value[..., np.newaxis]
+        if grad is not None:
+            result = result + grad * self.value[..., np.newaxis]
+        return _Dual(self.value * value, result)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        value, grad = _Dual._split(other)
+        result = self.grad / value[..., np.newaxis]
+        if grad is not None:
+            result = result - grad * (self.value / np.square(value))[..., np.newaxis]
+        return _Dual(self.value / value, result)
+
+    def __rtruediv__(self, other):
+        value = np.asarray(other)
+        return _Dual(value / self.value,
+                     -self.grad * (value / np.square(self.value))[..., np.newaxis])
 
+    def __pow__(self, other):
+        value, grad = _Dual._split(other)
+        result_value = self.value ** value
+        result = self.grad * (value * self.value ** (value - 1))[..., np.newaxis]
+        if grad is not None:
+            result = result + grad * (result_value * np.log(self.value))[..., np.newaxis]
+        return _Dual(result_value, result)
+
+    def __rpow__(self, other):
+        value = np.asarray(other)
+        result_value = value ** self.value
+        return _Dual(result_value, self.grad * (result_value * np.log(value))[..., np.newaxis])
+
+    def __abs__(self):
+        return _Dual(np.abs(self.value), self.grad * np.sign(self.value)[..., np.newaxis])
+
+def _feature_permutation(from_names, to_names):
+    """ Column indices that select to_names from an array with columns from_names
+
+    Returns None if no permutation is needed.
+    """
+    from_names = list(from_names)
+    try:
+        permutation = [from_names.index(name) for name in to_names]
+    except ValueError:
+        raise Exception('Features {!s} do not contain all of {!s}'.format(from_names, list(to_names)))
+    if permutation == list(range(len(from_names))):
+        return None
+    return np.array(permutation)
+
+def _feature_permutations(feature_names, networks):
+    """ _feature_permutation from feature_names to the features of every network
+
+    Returns None if a network uses features that are not in feature_names.
+    """
+    feature_names = list(feature_names)
+    for nn in networks:
+        if any(name not in feature_names for name in nn._feature_name_list):
+            return None
+    return [_feature_permutation(feature_names, nn._feature_name_list) for nn in networks]
+
+def _checked_frame(network, input, nn_input):
+    """ The DataFrame input, with the features of network replaced by the domain-checked nn_input """
+    if network._domain_guard is None:
+        return input
+    input = input.copy()
+    input[network._feature_name_list] = nn_input
+    return input
+
+def _permute(input, permutation):
+    if permutation is None:
+        return input
+    return input[:, permutation]
+
+def _fill_unknown(bound, fill):
+    """ Copy of bound as a float64 array, with unknown (NaN) bounds set to fill """
+    bound = np.array(bound, dtype='float64')
+    bound[np.isnan(bound)] = fill
+    return bound
+
+def clip_to_bounds(output, clip_low, clip_high, low_bound, high_bound):
+    """ Clip the columns of output in-place to their bounds
+
+    Bounds are per-column and may be passed in any shape with one element
+    per column, e.g. (n_targets, ) or (n_targets, 1). Bounds should not be
+    NaN, use -inf or inf for columns that should not be clipped.
+    """
+    if clip_low:
+        low_bound = np.ravel(low_bound)
+    else:
+        low_bound = None
     if clip_high:
-        for ii, bound in enumerate(high_bound):
-            output[:, ii][output[:, ii] > bound] = bound
+        high_bound = np.ravel(high_bound)
+    else:
+        high_bound = None
 
+    if low_bound is not None and high_bound is not None:
+        np.clip(output, low_bound, high_bound, out=output)
+    elif low_bound is not None:
+        np.maximum(output, low_bound, out=output)
+    elif high_bound is not None:
+        np.minimum(output, high_bound, out=output)
     return output
 
 def determine_settings(network, input, safe, clip_low, clip_high, low_bound, high_bound):
         if safe:
-            if input.__class__ == pd.DataFrame:
-                nn_input = input[network._feature_names]
+            if _is_dataframe(input):
+                # Select the columns on the array, not with an intermediate DataFrame
+                feature_names = network._feature_name_list
+                positions = {name: ii for ii, name in enumerate(input.columns)}
+                missing = [name for name in feature_names if name not in positions]
+                if len(missing) > 0:
+                    raise KeyError('Input is missing features {!s}'.format(missing))
+                columns = [positions[name] for name in feature_names]
+                nn_input = np.asarray(input.values[:, columns], dtype='float64')
             else:
                 raise Exception('Please pass a pandas.DataFrame for safe mode')
             if low_bound is not None:
@@ -383,56 +1926,28 @@ def determine_settings(network, input, safe, clip_low, clip_high, low_bound, hig
             if high_bound is not None:
                 high_bound = high_bound[network._target_names].values
         else:
-            if input.__class__ == pd.DataFrame:
+            if _is_dataframe(input):
                 nn_input = input.values
             elif input.__class__ == np.ndarray:
                 nn_input = input
 
+        # As the cached bounds, unknown bounds given by the caller do not clip
+        if low_bound is not None:
+            low_bound = _fill_unknown(low_bound, -np.inf)
+        if high_bound is not None:
+            high_bound = _fill_unknown(high_bound, np.inf)
         if clip_low is True and (low_bound is None):
-            low_bound = network._target_min.values
+            low_bound = network._target_bounds[0]
         if clip_high is True and (high_bound is None):
-            high_bound = network._target_max.values
+            high_bound = network._target_bounds[1]
         return nn_input, safe, clip_low, clip_high, low_bound, high_bound
 
-#@jit(float64[:,:](float64[:,:], float64[:], float64[:]), nopython=True)
 def _prescale(nn_input, factors, biases):
     return np.atleast_2d(factors) * nn_input + biases
-#    #return factors[np.newaxis, :] * nn_input + biases
-#
-#@jit(float64[:,:](float64[:,:]), nopython=True)
-def _act_none(x):
-    return x
-#
-#@jit(float64[:,:](float64[:,:]), nopython=True)
-def _act_relu(x):
-    return x * (x > 0)
-#
-##@jit(float64[:,:](float64[:,:], float64[:,:,:]), nopython=True)
-##def _apply_layers(self, input, layers):
-##    for layer in layers:
-##        input = layer.apply(input)
-##    return input
-#
-#def _create_apply(weight, bias, activation):
-#    #self.weight = weight
-#    #self.bias = bias
-#    #self.activation = activation
-#    #if activation is None:
-#    #    @jit(float64[:,:](float64[:,:]), nopython=True)
-#    #    def _apply_layer(input):
-#    #        preactivation = np.dot(input, weight) + bias
-#    #        result = preactivation
-#    #        return result
-#    #else:
-#    @jit(float64[:,:](float64[:,:]), nopython=True)
-#    def _apply_layer(input):
-#        preactivation = np.dot(input, weight) + bias
-#        result = activation(preactivation)
-#        return result
-#
-#    return _apply_layer
 
 if __name__ == '__main__':
+    from IPython import embed
+    import pandas as pd
     # Test the function
     root = os.path.dirname(os.path.realpath(__file__))
     #nn1 = QuaLiKizNDNN.from_json(os.path.join(root, 'nn_efe_GB.json'))